@@ -3,7 +3,7 @@ from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from celery import Celery
-import boto3
+from app.storage import S3Storage
 
 
 def make_celery(flask_app):
@@ -28,14 +28,12 @@ app.config.from_object(Config)
 
 celery = make_celery(app)
 
-s3_resource = boto3.resource('s3')
+storage = S3Storage(app.config)
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
-from app import models, routes
-
-db.create_all()
+from app import models, tasks, routes, commands
 
 # If we're running in stand alone mode, run the application
 if __name__ == '__main__':
@@ -0,0 +1,19 @@
+import click
+
+from app import app, db
+from app.models import Song
+
+
+@app.cli.command('create-db')
+def create_db():
+    """Создает таблицы, которых нет в базе (для разработки, в остальных случаях - flask db upgrade)."""
+    db.create_all()
+    click.echo('Database tables created')
+
+
+@app.cli.command('backfill-ratings')
+def backfill_ratings():
+    """Пересчитывает rating_count/rating_sum песен по таблице song_rating."""
+    Song.backfill_ratings()
+    db.session.commit()
+    click.echo('Song ratings backfilled')
@@ -4,7 +4,14 @@ from datetime import datetime, tzinfo, timedelta
 from passlib.apps import custom_app_context as pwd_context
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, BadSignature, SignatureExpired)
-from sqlalchemy.orm import backref
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import backref, joinedload
+from collections import OrderedDict, namedtuple
+import base64
+import hashlib
+import json
+import threading
+import time
 
 
 # Helpers methods
@@ -17,21 +24,124 @@ class simple_utc(tzinfo):
         return timedelta(0)
 
 
+def encode_cursor(song):
+    data = json.dumps([song.create_date.isoformat(), song.id])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    create_date, song_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return datetime.fromisoformat(create_date), int(song_id)
+
+
+# Данные юзера, которые нужны запросам после проверки токена
+UserIdentity = namedtuple('UserIdentity', ['id', 'username', 'email'])
+
+
+class TokenCache(object):
+    """
+    Кеш проверенных токенов: sha256 токена -> UserIdentity.
+    Запись живет ttl секунд, но не дольше самого токена
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).hexdigest()
+
+    def get(self, token):
+        key = self.key(token)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            identity, expires_at = item
+            if expires_at <= time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return identity
+
+    def put(self, token, identity, token_expires_at=None):
+        expires_at = time.time() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        with self._lock:
+            self._items[self.key(token)] = (identity, expires_at)
+            self._items.move_to_end(self.key(token))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, token):
+        # Для выхода: токен снова проверяется по базе
+        with self._lock:
+            self._items.pop(self.key(token), None)
+
+    def invalidate_user(self, user_id):
+        # Для смены пароля или удаления юзера: все его токены проверяются по базе
+        with self._lock:
+            for key in [k for k, (identity, _) in self._items.items() if identity.id == user_id]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+token_cache = TokenCache(app.config['TOKEN_CACHE_TTL'], app.config['TOKEN_CACHE_SIZE'])
+_token_serializer = Serializer(app.config['SECRET_KEY'])
+# Отдельная соль, чтобы токен потока нельзя было использовать как обычный и наоборот
+_stream_token_serializer = Serializer(app.config['SECRET_KEY'], expires_in=app.config['STATUS_STREAM_TOKEN_TTL'],
+                                      salt='status-stream')
+
+
 def is_token_valid(token):
-    user = User.verify_auth_token(token)
-    if not user:
+    if not token:
         return False
-    g.user = user
+
+    identity = token_cache.get(token)
+    if identity is None:
+        identity = User.verify_auth_token(token)
+        if not identity:
+            return False
+    g.user = identity
     return True
 
 
+def generate_stream_token(user_id, song_id):
+    """
+    Короткий токен, который открывает только SSE поток статуса одной мелодии
+    """
+    return _stream_token_serializer.dumps({'user_id': user_id, 'song_id': int(song_id)}).decode('ascii')
+
+
+def verify_stream_token(token, song_id):
+    """
+    :return: id юзера или None, если токен неверный, истек или выдан для другой мелодии
+    """
+    try:
+        data = _stream_token_serializer.loads(token)
+    except (SignatureExpired, BadSignature):
+        return None
+    if str(data.get('song_id')) != str(song_id):
+        return None
+    return data.get('user_id')
+
+
 # Models
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
-    create_date = db.Column(db.DateTime, index=True, default=datetime.now())
+    create_date = db.Column(db.DateTime, index=True, default=datetime.now)
     password_hash = db.Column(db.String(128))
 
     def hash_password(self, password):
@@ -46,15 +156,26 @@ class User(db.Model):
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(app.config['SECRET_KEY'])
+        """
+        Проверяет токен и кладет данные юзера в token_cache
+        :return: UserIdentity или None
+        """
         try:
-            data = s.loads(token)
+            data, header = _token_serializer.loads(token, return_header=True)
         except SignatureExpired:
             return None
         except BadSignature:
             return None
         user = User.query.get(data['id'])
-        return user
+        if user is None:
+            return None
+        identity = user.identity
+        token_cache.put(token, identity, header.get('exp'))
+        return identity
+
+    @property
+    def identity(self):
+        return UserIdentity(id=self.id, username=self.username, email=self.email)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -75,6 +196,8 @@ class SongRating(db.Model):
     user_id = db.Column(db.Integer)
     rating = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (db.Index('ix_song_rating_song_id_user_id', 'song_id', 'user_id', unique=True),)
+
 
 class SynthInfo(db.Model):
     __tablename__ = 'synth_info'
@@ -83,6 +206,8 @@ class SynthInfo(db.Model):
     song_id = db.Column(db.Integer)
     processing_complete = db.Column(db.Boolean, default=False)
     genre = db.Column(db.String(64))
+    # Задача celery части пачки, в которой обрабатывается мелодия (None - отдельная задача)
+    task_id = db.Column(db.String(64), index=True, nullable=True)
 
     @property
     def serialize(self):
@@ -99,12 +224,15 @@ class Song(db.Model):
     __tablename__ = 'song'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
-    create_date = db.Column(db.DateTime, index=True, default=datetime.now())
+    create_date = db.Column(db.DateTime, index=True, default=datetime.now)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship("User", backref=backref('user', uselist=False))
     is_public = db.Column(db.Boolean, default=False)
     synth_info_id = db.Column(db.Integer, db.ForeignKey('synth_info.id'), nullable=True)
     synth_info = db.relationship("SynthInfo", backref=backref('synth_info', uselist=False))
+    # Количество и сумма оценок, обновляются в rate_songs
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     @property
     def user_rating(self):
@@ -115,23 +243,103 @@ class Song(db.Model):
 
     @property
     def average_rating(self):
-        if SongRating.query.filter_by(song_id=self.id).first() is None:
+        if not self.rating_count:
             return None
+        return self.rating_sum / float(self.rating_count)
 
-        song_ratings = SongRating.query.filter_by(song_id=self.id).all()
-        int_array = [i.rating for i in song_ratings]
-        return sum(int_array) / float(len(int_array))
+    @staticmethod
+    def add_rating(song_id, user_id, score):
+        """
+        Сохраняет оценку юзера и обновляет rating_count/rating_sum песни
+        в той же транзакции. Коммит делает вызывающий код
+        """
+        song_rating = SongRating.query.filter_by(song_id=song_id, user_id=user_id).first()
+
+        if song_rating is None:
+            song_rating = SongRating(song_id=song_id, user_id=user_id, rating=score)
+            count_delta, sum_delta = 1, score
+        else:
+            count_delta, sum_delta = 0, score - song_rating.rating
+            song_rating.rating = score
+        db.session.add(song_rating)
+
+        Song.query.filter_by(id=song_id).update({
+            Song.rating_count: Song.rating_count + count_delta,
+            Song.rating_sum: Song.rating_sum + sum_delta
+        }, synchronize_session=False)
+        return song_rating
+
+    @staticmethod
+    def backfill_ratings():
+        """
+        Пересчитывает rating_count/rating_sum всех песен по song_rating
+        """
+        count = db.session.query(func.count(SongRating.id)) \
+            .filter(SongRating.song_id == Song.id).correlate(Song).as_scalar()
+        total = db.session.query(func.coalesce(func.sum(SongRating.rating), 0)) \
+            .filter(SongRating.song_id == Song.id).correlate(Song).as_scalar()
+        Song.query.update({Song.rating_count: count, Song.rating_sum: total}, synchronize_session=False)
 
     @property
     def serialize(self):
+        return self.to_dict(self.average_rating, self.user_rating)
+
+    def to_dict(self, rating, user_rating):
         return {
             'id': self.id,
             'name': self.name,
             'create_date': self.create_date.replace(tzinfo=simple_utc()).isoformat(),
-            'rating': self.average_rating,
-            'user_rating': self.user_rating,
+            'rating': rating,
+            'user_rating': user_rating,
             'is_public': self.is_public,
             'user': self.user.serialize,
             'synth_info': None if self.synth_info is None else self.synth_info.serialize
         }
 
+    @staticmethod
+    def filter_query(query, genre=None, processed=None, min_rating=None):
+        if genre is not None or processed is not None:
+            query = query.join(SynthInfo, Song.synth_info_id == SynthInfo.id)
+        if genre is not None:
+            query = query.filter(SynthInfo.genre == genre)
+        if processed is not None:
+            query = query.filter(SynthInfo.processing_complete == processed)
+        if min_rating is not None:
+            query = query.filter(Song.rating_count > 0, Song.rating_sum >= min_rating * Song.rating_count)
+        return query
+
+    @staticmethod
+    def page(query, cursor=None, limit=20):
+        """
+        Страница песен от новых к старым по (create_date, id) вместе с user и synth_info.
+        Возвращает песни и курсор следующей страницы (None, если это последняя)
+        """
+        query = query.options(joinedload(Song.user), joinedload(Song.synth_info)) \
+            .order_by(Song.create_date.desc(), Song.id.desc())
+        if cursor:
+            create_date, song_id = decode_cursor(cursor)
+            query = query.filter(or_(Song.create_date < create_date,
+                                     and_(Song.create_date == create_date, Song.id < song_id)))
+
+        songs = query.limit(limit + 1).all()
+        next_cursor = encode_cursor(songs[limit - 1]) if len(songs) > limit else None
+        return songs[:limit], next_cursor
+
+    @staticmethod
+    def serialize_list(songs):
+        """
+        Сериализует список песен (user и synth_info загружены в page)
+        одним запросом рейтингов текущего юзера вместо нескольких на каждую песню
+        """
+        if not songs:
+            return []
+        song_ids = [song.id for song in songs]
+
+        user_ratings = dict(
+            db.session.query(SongRating.song_id, SongRating.rating)
+            .filter(SongRating.song_id.in_(song_ids), SongRating.user_id == g.user.id)
+            .all()
+        )
+
+        return [song.to_dict(song.average_rating, user_ratings.get(song.id)) for song in songs]
+
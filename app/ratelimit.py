@@ -0,0 +1,37 @@
+import time
+
+import redis
+
+
+class RateLimiter(object):
+    """
+    Ограничение числа действий юзера: не больше limit за window секунд.
+    Счетчики в redis, поэтому лимит общий для всех процессов веб-приложения
+    """
+
+    def __init__(self, redis_url, limit, window, prefix='rate'):
+        self.redis_url = redis_url
+        self.limit = limit
+        self.window = window
+        self.prefix = prefix
+        self._redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.StrictRedis.from_url(self.redis_url)
+        return self._redis
+
+    def hit(self, user_id, amount=1):
+        """
+        Засчитывает amount действий юзера
+        :return: False, если лимит превышен
+        """
+        if not self.limit:
+            return True
+        key = f'{self.prefix}:{user_id}:{int(time.time() // self.window)}'
+        pipe = self.redis.pipeline()
+        pipe.incr(key, amount)
+        pipe.expire(key, self.window)
+        count, _ = pipe.execute()
+        return count <= self.limit
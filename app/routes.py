@@ -1,16 +1,38 @@
 import os
-from flask import abort, request, jsonify, g, flash, send_file
-from app import app, db, celery, s3_resource
-from celery.signals import task_prerun, task_postrun
-from app.models import User, Song, SongRating, SynthInfo, is_token_valid
-from ml_models.model_processing import proc
+from datetime import datetime
+from flask import abort, request, jsonify, g, flash, redirect, Response
+from botocore.exceptions import ClientError
+from urllib.parse import quote
+from app import app, db, celery, storage
+from celery import chord, group
+from celery.result import GroupResult
+from app.ratelimit import RateLimiter
+from app.models import User, Song, SynthInfo, is_token_valid, generate_stream_token, verify_stream_token
+from app.tasks import process_midi_file, process_midi_batch, process_midi_batch_done, processing_task_id, \
+    preview_key
+from sqlalchemy.orm import joinedload
+from ml_models.genres import get_genres as get_available_genres
 from werkzeug.utils import secure_filename
-import shutil
+import json
+import threading
+import zipfile
+import uuid
 import time
-import gc
 
 ALLOWED_SONG_EXTENSIONS = {'mid'}
 
+processing_rate_limiter = RateLimiter(app.config['CELERY_BROKER_URL'],
+                                      app.config['PROCESSING_RATE_LIMIT'],
+                                      app.config['PROCESSING_RATE_WINDOW'],
+                                      prefix='rate:process')
+# Открытые SSE потоки статуса в этом процессе gunicorn
+status_streams = threading.BoundedSemaphore(app.config['STATUS_STREAM_MAX'])
+# У пачек свой лимит, рассчитанный на BATCH_MAX_FILES мелодий за раз
+batch_rate_limiter = RateLimiter(app.config['CELERY_BROKER_URL'],
+                                 app.config['BATCH_RATE_LIMIT'],
+                                 app.config['BATCH_RATE_WINDOW'],
+                                 prefix='rate:batch')
+
 
 def json_error(error_message):
     return jsonify({"message": error_message})
@@ -21,52 +43,178 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_SONG_EXTENSIONS
 
 
-@task_postrun.connect
-def close_session(*args, **kwargs):
-    with app.app_context():
-        db.session.remove()
+def song_list_response(songs):
+    """
+    Страница списка песен по параметрам запроса:
+    limit, cursor, genre, processed, min_rating.
+    Курсор следующей страницы отдается в заголовке X-Next-Cursor
+    """
+    try:
+        limit = int(request.args.get('limit', app.config['SONGS_PAGE_SIZE']))
+        limit = max(1, min(limit, app.config['SONGS_MAX_PAGE_SIZE']))
+        processed = request.args.get('processed')
+        if processed is not None:
+            processed = processed.lower() in ('1', 'true')
+        min_rating = request.args.get('min_rating')
+        if min_rating is not None:
+            min_rating = float(min_rating)
+
+        songs = Song.filter_query(songs, genre=request.args.get('genre'),
+                                  processed=processed, min_rating=min_rating)
+        songs, next_cursor = Song.page(songs, request.args.get('cursor'), limit)
+    except (ValueError, TypeError):
+        return json_error("Неправильные параметры запроса"), 400
+
+    response = jsonify(Song.serialize_list(songs))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 
-@task_prerun.connect
-def on_task_init(*args, **kwargs):
-    with app.app_context():
-        db.engine.dispose()
+def attachment_header(filename):
+    return f"attachment; filename*=UTF-8''{quote(filename)}"
 
 
-@celery.task()
-def process_midi_file(filename, genre, synth_info_id, user_id):
-    with app.app_context():
-        gc.collect()
+def presigned_download_url(s3_file_path, filename):
+    return storage.presigned_url(s3_file_path, ResponseContentDisposition=attachment_header(filename))
 
 
-        # Downloading file from S3 temp dir
-        temp_dir = app.config['TEMP_UPLOAD_URL']
-        if os.path.isdir(temp_dir) is False:
-            os.mkdir(temp_dir)
-        temp_file_path = f'{temp_dir}/{filename}'
+def stream_s3_file(s3_file_path, filename):
+    """
+    Отдает файл из S3 кусками, не сохраняя его на диск.
+    Поддерживает Range и If-None-Match, которые передаются в S3 как есть
+    """
+    params = {}
+    if request.headers.get('Range'):
+        params['Range'] = request.headers['Range']
+    if request.headers.get('If-None-Match'):
+        params['IfNoneMatch'] = request.headers['If-None-Match']
+
+    try:
+        s3_object = storage.get_object(s3_file_path, **params)
+    except ClientError as e:
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+        if status == 304:
+            return Response(status=304, headers={'ETag': request.headers['If-None-Match']})
+        if status == 416:
+            return Response(status=416)
+        if status == 404:
+            return json_error("Файл мелодии не найден"), 404
+        raise
+
+    body = s3_object['Body']
+    chunk_size = app.config['S3_DOWNLOAD_CHUNK_SIZE']
+
+    def generate():
+        try:
+            for chunk in iter(lambda: body.read(chunk_size), b''):
+                yield chunk
+        finally:
+            body.close()
+
+    headers = {
+        'Content-Length': str(s3_object['ContentLength']),
+        'Content-Disposition': attachment_header(filename),
+        'Accept-Ranges': 'bytes',
+        'ETag': s3_object['ETag']
+    }
+    status = 200
+    if s3_object.get('ContentRange'):
+        headers['Content-Range'] = s3_object['ContentRange']
+        status = 206
+
+    return Response(generate(), status=status, headers=headers,
+                    mimetype=s3_object.get('ContentType') or 'audio/midi', direct_passthrough=True)
+
+
+def create_processing_songs(names, genre, raw_song_id, user_id, task_ids=None):
+    """
+    Создает песни и synth info для их обработки, связанные друг с другом.
+    Каждая таблица пишется одним executemany, id читаются обратно
+    по имени песни (оно уникально). Коммит делает вызывающий код
+    task_ids - задача celery части пачки для каждой песни
+    :return: [(song, synth_info)] в порядке names
+    """
+    task_ids = task_ids or [None] * len(names)
+    now = datetime.now()
+    db.session.bulk_insert_mappings(Song, [{'name': name, 'user_id': user_id, 'create_date': now} for name in names])
+    song_ids = dict(db.session.query(Song.name, Song.id).filter(Song.user_id == user_id, Song.name.in_(names)))
 
-        temp_bucket_dir = app.config['S3_TEMP_DIR_NAME']
-        s3_file_path = f'{temp_bucket_dir}/{filename}'
+    db.session.bulk_insert_mappings(SynthInfo, [
+        {'song_id': song_ids[name], 'raw_song_id': raw_song_id, 'genre': genre,
+         'processing_complete': False, 'task_id': task_id}
+        for name, task_id in zip(names, task_ids)
+    ])
+    synth_info_ids = dict(db.session.query(SynthInfo.song_id, SynthInfo.id)
+                          .filter(SynthInfo.song_id.in_(list(song_ids.values()))))
+    db.session.bulk_update_mappings(Song, [{'id': song_id, 'synth_info_id': synth_info_ids[song_id]}
+                                           for song_id in song_ids.values()])
 
-        s3_resource.Object(app.config['S3_BUCKET_NAME'], s3_file_path) \
-            .download_file(temp_file_path)
-        s3_resource.Object(app.config['S3_BUCKET_NAME'], s3_file_path).delete()
+    songs = Song.query.options(joinedload(Song.user), joinedload(Song.synth_info)) \
+        .filter(Song.id.in_(list(song_ids.values())))
+    songs = {song.name: song for song in songs}
+    return [(songs[name], songs[name].synth_info) for name in names]
 
-        # Start processing file
-        processed_file = proc(temp_file_path, genre)
 
-        # Upload on S3 processed file
-        s3_resource.Object(app.config['S3_BUCKET_NAME'], str(user_id) + "/" + filename) \
-            .upload_file(Filename=processed_file)
+def create_processing_song(name, genre, raw_song_id, user_id):
+    return create_processing_songs([name], genre, raw_song_id, user_id)[0]
 
-        # Saving info in DB
-        synth_info = SynthInfo.query.filter_by(id=synth_info_id).first()
-        synth_info.processing_complete = True
-        db.session.add(synth_info)
-        db.session.commit()
 
-        #TODO: remove temp file
-        print(f'Processing of synthInfo {synth_info_id} is completed')
+class BatchError(Exception):
+    pass
+
+
+def batch_files():
+    """
+    Мелодии пачки из запроса: поле songs (несколько файлов) и zip архив в поле archive.
+    Количество и размеры файлов архива проверяются по его оглавлению, сами файлы
+    распаковываются потом, по одному, прямо в S3
+    :return: [(имя, размер, функция, которая открывает файл)]
+    """
+    files = []
+    for file in request.files.getlist('songs'):
+        if file.filename and allowed_file(file.filename):
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            files.append((file.filename, size, lambda stream=file.stream: stream))
+
+    if 'archive' in request.files:
+        archive = zipfile.ZipFile(request.files['archive'].stream)
+        members = [info for info in archive.infolist()
+                   if not info.is_dir() and allowed_file(os.path.basename(info.filename))]
+        if len(files) + len(members) > app.config['BATCH_MAX_FILES']:
+            raise BatchError(f"В пачке может быть не больше {app.config['BATCH_MAX_FILES']} мелодий")
+
+        max_size = app.config['BATCH_MAX_FILE_SIZE']
+        for info in members:
+            if info.file_size > max_size:
+                raise BatchError(f"Мелодия {info.filename} больше {max_size // (1024 * 1024)} МБ")
+            # ZipExtFile не отдает больше file_size байт, даже если архив врет
+            files.append((os.path.basename(info.filename), info.file_size,
+                          lambda info=info: archive.open(info)))
+    return files
+
+
+def processing_queue(genre, size):
+    """
+    Очередь для обработки: по жанру (PROCESSING_GENRE_QUEUES) и размеру файла,
+    чтобы большие файлы не задерживали короткие
+    """
+    base = app.config['PROCESSING_GENRE_QUEUES'].get(genre, app.config['PROCESSING_QUEUE'])
+    size_class = 'large' if size > app.config['PROCESSING_LARGE_FILE_SIZE'] else 'small'
+    return f'{base}.{size_class}'
+
+
+def enqueue_processing(filename, genre, synth_info_id, user_id, size, s3_key=None):
+    """
+    Ставит обработку в очередь с task_id по synth_info, чтобы статус можно было найти по песне
+    """
+    return process_midi_file.apply_async(args=(filename, genre, synth_info_id, user_id),
+                                         kwargs={'s3_key': s3_key},
+                                         task_id=processing_task_id(synth_info_id),
+                                         queue=processing_queue(genre, size))
+
 
 # ROUTES
 @app.route('/api/users', methods=['POST'])
@@ -111,13 +259,7 @@ def login_user():
 
 @app.route('/api/genres', methods=['GET'])
 def get_genres():
-    genres = []
-    for filename in os.listdir('ml_models/models'):
-        path = os.path.join('ml_models/models', filename)
-        if os.path.isfile(path):
-            if "DS" not in filename:
-                genres.append(filename[:-3])
-    return jsonify(genres)
+    return jsonify(get_available_genres())
 
 
 @app.route('/api/songs/upload', methods=['POST'])
@@ -152,8 +294,7 @@ def upload_song():
 
     file_path = str(g.user.id) + "/" + file.filename
 
-    s3_resource.Object(app.config['S3_BUCKET_NAME'], file_path) \
-        .upload_file(Filename=os.path.join(temp_dir, file.filename))
+    storage.upload_file(file_path, os.path.join(temp_dir, file.filename))
 
     song = Song(name=file.filename)
     song.user_id = g.user.id
@@ -175,58 +316,401 @@ def process_song():
     if not genre:
         return json_error("Необходимо указать жанр"), 500
 
+    if genre not in get_available_genres():
+        return json_error("Такого жанра не существует"), 500
+
     if 'song' not in request.files:
         flash('No file part')
         return json_error("Не удалось загрузить файл на сервер"), 500
 
-    temp_dir = app.config['TEMP_UPLOAD_URL']
-    if os.path.isdir(temp_dir) is False:
-        os.mkdir(temp_dir)
-
     file = request.files['song']
     if file.filename == '':
         flash('No selected file')
         return json_error("Имя файла не должно быть пустым"), 500
+    if not allowed_file(file.filename):
+        return json_error("Не удалось загрузить файл на сервер"), 500
 
     existing_song = Song.query.filter_by(name=file.filename, user_id=g.user.id).first()
     if existing_song:
         return json_error("Мелодия с таким названием уже имеется у вас библиотеке"), 500
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(temp_dir, filename))
+    if not processing_rate_limiter.hit(g.user.id):
+        return json_error("Слишком много мелодий на обработке, попробуйте позже"), 429
 
-    # Create song in DB
-    song = Song(name=file.filename)
-    song.user_id = g.user.id
-    db.session.add(song)
+    # Upload to temp dir in S3 straight from request, without saving on local disk
+    temp_bucket_dir = app.config['S3_TEMP_DIR_NAME']
+    s3_key = f'{temp_bucket_dir}/{g.user.id}/{uuid.uuid4().hex}/{secure_filename(file.filename)}'
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    storage.upload_fileobj(s3_key, file.stream)
+
+    # Create song and synth info for processing song in DB
+    song, synth_info = create_processing_song(file.filename, genre, request.args.get("raw_song_id"), g.user.id)
     db.session.commit()
 
-    # Create synth info for procesing song
-    synth_info = SynthInfo(song_id=song.id)
-    synth_info.raw_song_id = request.args.get("raw_song_id")
-    synth_info.genre = genre
-    synth_info.processing_complete = False
-    db.session.add(synth_info)
-    db.session.commit()
+    # Delay task on celery
+    enqueue_processing(file.filename, genre, synth_info.id, g.user.id, size, s3_key=s3_key)
 
-    # Bind synth_info_id to song
-    song.synth_info_id = synth_info.id
+    return jsonify(song.serialize)
+
+
+@app.route('/api/songs/process/batch', methods=['POST'])
+def process_songs_batch():
+    """
+    Загружает пачку мелодий (файлы songs или zip архив archive) и отправляет
+    их на обработку частями по BATCH_CHUNK_SIZE файлов одного жанра
+    :return: {batch_id, songs: Array<Song>, skipped: Array<String>}
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    genre = request.args.get("genre")
+    if genre not in get_available_genres():
+        return json_error("Такого жанра не существует"), 500
+
+    try:
+        files = batch_files()
+    except zipfile.BadZipFile:
+        return json_error("Не удалось распаковать архив"), 500
+    except BatchError as e:
+        return json_error(str(e)), 500
+
+    if not files:
+        return json_error("Не удалось загрузить файл на сервер"), 500
+    if len(files) > app.config['BATCH_MAX_FILES']:
+        return json_error(f"В пачке может быть не больше {app.config['BATCH_MAX_FILES']} мелодий"), 500
+
+    # Skip files already in user library and repeated names
+    names = [name for name, _, _ in files]
+    existing = {song.name for song in Song.query.filter(Song.user_id == g.user.id, Song.name.in_(names))}
+    skipped, unique_files = [], {}
+    for name, size, open_file in files:
+        if name in existing or name in unique_files:
+            skipped.append(name)
+        else:
+            unique_files[name] = (size, open_file)
+
+    if not unique_files:
+        return json_error("Мелодии с такими названиями уже имеются у вас библиотеке"), 500
+
+    if not batch_rate_limiter.hit(g.user.id, len(unique_files)):
+        return json_error("Слишком много мелодий на обработке, попробуйте позже"), 429
+
+    # Upload to temp dir in S3 straight from request, archive members one at a time
+    temp_bucket_dir = app.config['S3_TEMP_DIR_NAME']
+    uploads = []
+    for name, (size, open_file) in unique_files.items():
+        s3_key = f'{temp_bucket_dir}/{g.user.id}/{uuid.uuid4().hex}/{secure_filename(name)}'
+        with open_file() as file:
+            storage.upload_fileobj(s3_key, file)
+        uploads.append((name, s3_key, size))
+
+    # One task per chunk, so that worker reuses loaded model for the whole chunk.
+    # Task ids are known in advance and saved with every song of the chunk
+    chunk_size = app.config['BATCH_CHUNK_SIZE']
+    chunk_task_ids = [uuid.uuid4().hex for _ in range(0, len(uploads), chunk_size)]
+    task_ids = [chunk_task_ids[index // chunk_size] for index in range(len(uploads))]
+
+    # Create all songs and synth infos in one transaction
+    created = create_processing_songs(list(unique_files), genre, request.args.get("raw_song_id"), g.user.id,
+                                      task_ids)
     db.session.commit()
 
-    # Upload to temp dir in S3
+    tasks = []
+    for start, task_id in zip(range(0, len(created), chunk_size), chunk_task_ids):
+        chunk = list(zip(uploads[start:start + chunk_size], created[start:start + chunk_size]))
+        items = [(name, synth_info.id, s3_key) for (name, s3_key, _), (_, synth_info) in chunk]
+        size = sum(size for (_, _, size), _ in chunk)
+        tasks.append(process_midi_batch.signature((items, genre, g.user.id), task_id=task_id,
+                                                  queue=processing_queue(genre, size)))
+
+    result = chord(group(tasks))(process_midi_batch_done.s())
+    result.parent.save()
+
+    return jsonify({
+        'batch_id': result.parent.id,
+        'songs': Song.serialize_list([song for song, _ in created]),
+        'skipped': skipped
+    })
+
+
+def is_batch_owner(batch, user_id):
+    """
+    Пачка принадлежит юзеру, если все мелодии ее частей - его
+    """
+    owners = db.session.query(Song.user_id).join(SynthInfo, Song.synth_info_id == SynthInfo.id) \
+        .filter(SynthInfo.task_id.in_([result.id for result in batch.results])).distinct().all()
+    return [owner for owner, in owners] == [user_id]
+
+
+@app.route('/api/songs/batch/<batch_id>/status', methods=['GET'])
+def get_batch_status(batch_id):
+    """
+    Общий прогресс обработки пачки мелодий
+    :return: {batch_id, status, progress, done, failed}
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    batch = GroupResult.restore(batch_id, app=celery)
+    if batch is None or not is_batch_owner(batch, g.user.id):
+        return json_error("Пачка с таким идентификатором не найдена"), 404
+
+    progress, done, failed = 0, 0, 0
+    for result in batch.results:
+        if result.state == 'SUCCESS':
+            progress += 1
+            done += result.result['done']
+            failed += result.result['failed']
+        elif result.state == 'FAILURE':
+            progress += 1
+        elif result.state == 'PROGRESS' and result.info:
+            progress += (result.info['done'] + result.info['failed']) / float(result.info['total'])
+            done += result.info['done']
+            failed += result.info['failed']
+
+    return jsonify({
+        'batch_id': batch_id,
+        'status': 'done' if batch.ready() else 'running',
+        'progress': round(progress / len(batch.results), 2) if batch.results else 1,
+        'done': done,
+        'failed': failed
+    })
+
+
+@app.route('/api/songs/process/upload', methods=['POST'])
+def request_song_upload():
+    """
+    Выдает presigned POST для загрузки мелодии напрямую в S3.
+    После загрузки клиент вызывает /api/songs/process/confirm с полученным key
+    :return: {url, fields, key}
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    genre = request.args.get("genre")
+    if genre not in get_available_genres():
+        return json_error("Такого жанра не существует"), 500
+
+    filename = request.args.get("filename")
+    if not filename or not allowed_file(filename):
+        return json_error("Имя файла не должно быть пустым"), 500
+
+    existing_song = Song.query.filter_by(name=filename, user_id=g.user.id).first()
+    if existing_song:
+        return json_error("Мелодия с таким названием уже имеется у вас библиотеке"), 500
+
     temp_bucket_dir = app.config['S3_TEMP_DIR_NAME']
-    s3_file_path = f'{temp_bucket_dir}/{file.filename}'
-    local_file_path = os.path.join(temp_dir, file.filename)
-    s3_resource.Object(app.config['S3_BUCKET_NAME'], s3_file_path) \
-        .upload_file(Filename=local_file_path)
+    s3_key = f'{temp_bucket_dir}/{g.user.id}/{uuid.uuid4().hex}/{secure_filename(filename)}'
+    post = storage.presigned_post(s3_key, [['content-length-range', 1, app.config['S3_UPLOAD_MAX_SIZE']]])
+    return jsonify({'url': post['url'], 'fields': post['fields'], 'key': s3_key})
 
-    # Delay task on celery
-    process_midi_file.delay(file.filename, genre, synth_info.id, g.user.id)
+
+@app.route('/api/songs/process/confirm', methods=['POST'])
+def confirm_song_upload():
+    """
+    Создает песню по файлу, загруженному в S3 через presigned POST,
+    и отправляет ее на обработку
+    :return: Song
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    genre = request.args.get("genre")
+    if genre not in get_available_genres():
+        return json_error("Такого жанра не существует"), 500
+
+    filename = request.args.get("filename")
+    s3_key = request.args.get("key") or ''
+    temp_bucket_dir = app.config['S3_TEMP_DIR_NAME']
+    if not filename or not s3_key.startswith(f'{temp_bucket_dir}/{g.user.id}/'):
+        return json_error("Не удалось загрузить файл на сервер"), 500
+
+    existing_song = Song.query.filter_by(name=filename, user_id=g.user.id).first()
+    if existing_song:
+        return json_error("Мелодия с таким названием уже имеется у вас библиотеке"), 500
+
+    try:
+        s3_object = storage.head_object(s3_key)
+    except ClientError:
+        return json_error("Не удалось загрузить файл на сервер"), 500
+
+    if not processing_rate_limiter.hit(g.user.id):
+        return json_error("Слишком много мелодий на обработке, попробуйте позже"), 429
+
+    song, synth_info = create_processing_song(filename, genre, request.args.get("raw_song_id"), g.user.id)
+    db.session.commit()
+
+    enqueue_processing(filename, genre, synth_info.id, g.user.id, s3_object['ContentLength'], s3_key=s3_key)
 
     return jsonify(song.serialize)
 
 
+def processing_status(synth_info):
+    """
+    Статус обработки по базе и result backend celery:
+    queued / running (со stage и progress) / done / failed
+    """
+    if synth_info.processing_complete:
+        return {'status': 'done', 'stage': None, 'progress': 1}
+    return backend_status(synth_info.id, synth_info.task_id)
+
+
+def backend_status(synth_info_id, chunk_task_id=None):
+    """
+    Статус обработки только по result backend celery, без базы.
+    chunk_task_id - задача части пачки, если мелодия из пачки
+    """
+    result = celery.AsyncResult(processing_task_id(synth_info_id))
+    state = result.state
+    if state == 'PENDING' and chunk_task_id:
+        # Мелодия из пачки, до которой воркер еще не дошел: если упала
+        # вся часть пачки, до мелодии он уже не дойдет
+        if celery.AsyncResult(chunk_task_id).state in ('FAILURE', 'REVOKED'):
+            return {'status': 'failed', 'stage': None, 'progress': None}
+    if state == 'PROGRESS':
+        info = result.info or {}
+        return {'status': 'running', 'stage': info.get('stage'), 'progress': info.get('progress')}
+    if state == 'STARTED':
+        return {'status': 'running', 'stage': None, 'progress': 0}
+    if state == 'SUCCESS':
+        return {'status': 'done', 'stage': None, 'progress': 1}
+    if state in ('FAILURE', 'REVOKED'):
+        return {'status': 'failed', 'stage': None, 'progress': None}
+    return {'status': 'queued', 'stage': None, 'progress': 0}
+
+
+def find_processing_song(song_id, user_id):
+    song = Song.query.filter_by(id=song_id, user_id=user_id).first()
+    if song is None or song.synth_info is None:
+        return None, None
+    return song, song.synth_info
+
+
+@app.route('/api/songs/<song_id>/status', methods=['GET'])
+def get_song_status(song_id):
+    """
+    Статус обработки мелодии
+    :return: {song_id, synth_info_id, status, stage, progress}
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    song, synth_info = find_processing_song(song_id, g.user.id)
+    if song is None:
+        return json_error("Мелодия с таким идентификатором не найдена"), 404
+
+    status = processing_status(synth_info)
+    return jsonify(dict(status, song_id=song.id, synth_info_id=synth_info.id))
+
+
+@app.route('/api/songs/<song_id>/status/token', methods=['POST'])
+def get_song_status_token(song_id):
+    """
+    Токен для /status/stream: EventSource не умеет заголовки, а основной токен
+    в url попал бы в логи. Этот живет STATUS_STREAM_TOKEN_TTL секунд и
+    подходит только для потока статуса этой мелодии
+    :return: {token, expires_in}
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    song, _ = find_processing_song(song_id, g.user.id)
+    if song is None:
+        return json_error("Мелодия с таким идентификатором не найдена"), 404
+
+    return jsonify({'token': generate_stream_token(g.user.id, song.id),
+                    'expires_in': app.config['STATUS_STREAM_TOKEN_TTL']})
+
+
+@app.route('/api/songs/<song_id>/status/stream', methods=['GET'])
+def stream_song_status(song_id):
+    """
+    Server-sent events со статусом обработки мелодии, пока она не завершится.
+    Вместо заголовка Authorization можно передать stream_token из /status/token
+    """
+    stream_token = request.args.get("stream_token")
+    if stream_token:
+        user_id = verify_stream_token(stream_token, song_id)
+        if user_id is None:
+            return abort(401)
+    elif is_token_valid(request.headers.get("Authorization")):
+        user_id = g.user.id
+    else:
+        return abort(401)
+
+    song, synth_info = find_processing_song(song_id, user_id)
+    if song is None:
+        return json_error("Мелодия с таким идентификатором не найдена"), 404
+
+    ids = {'song_id': song.id, 'synth_info_id': synth_info.id}
+    chunk_task_id = synth_info.task_id
+    status = processing_status(synth_info)
+    # Соединение с базой не держим, пока поток открыт
+    db.session.remove()
+
+    # Каждый поток занимает поток gunicorn, поэтому их число ограничено,
+    # остальные клиенты опрашивают /status
+    if status['status'] not in ('done', 'failed') and not status_streams.acquire(blocking=False):
+        response = json_error("Слишком много открытых потоков статуса, используйте /status")
+        return response, 503, {'Retry-After': str(app.config['STATUS_STREAM_RETRY_AFTER'])}
+
+    interval = app.config['STATUS_STREAM_INTERVAL']
+    timeout = app.config['STATUS_STREAM_TIMEOUT']
+
+    def final_status():
+        # База читается один раз, когда result backend говорит, что обработка закончилась.
+        # Ответ отдается уже после выхода из запроса, поэтому свой контекст приложения
+        with app.app_context():
+            try:
+                synth_info = SynthInfo.query.get(ids['synth_info_id'])
+                if synth_info is None:
+                    # Мелодию удалили, пока поток был открыт
+                    return {'status': 'failed', 'stage': None, 'progress': None}
+                return processing_status(synth_info)
+            finally:
+                db.session.remove()
+
+    def generate(status):
+        started = time.time()
+        last = None
+        while True:
+            if status != last:
+                yield f'data: {json.dumps(dict(status, **ids))}\n\n'
+                last = status
+            if status['status'] in ('done', 'failed') or time.time() - started > timeout:
+                return
+            time.sleep(interval)
+            status = backend_status(ids['synth_info_id'], chunk_task_id)
+            if status['status'] in ('done', 'failed'):
+                status = final_status()
+
+    response = Response(generate(status), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if status['status'] not in ('done', 'failed'):
+        response.call_on_close(status_streams.release)
+    return response
+
+
+@app.route('/api/songs/<song_id>/preview', methods=['GET'])
+def download_song_preview(song_id):
+    """
+    Частичный результат, пока мелодия обрабатывается потоково
+    (STREAM_PREVIEW_EVERY), после обработки его нет
+    :return: file from amazon
+    """
+    if not is_token_valid(request.headers.get("Authorization")):
+        return abort(401)
+
+    song, _ = find_processing_song(song_id, g.user.id)
+    if song is None:
+        return json_error("Мелодия с таким идентификатором не найдена"), 404
+
+    s3_file_path = preview_key(str(g.user.id) + "/" + song.name)
+    return stream_s3_file(s3_file_path, os.path.basename(s3_file_path))
+
+
 @app.route('/api/songs', methods=['GET'])
 def get_songs():
     """
@@ -238,7 +722,7 @@ def get_songs():
 
     songs = Song.query.filter_by(user_id=g.user.id)
 
-    return jsonify([i.serialize for i in songs.all()])
+    return song_list_response(songs)
 
 
 @app.route('/api/songs/<song_id>', methods=['GET', 'DELETE'])
@@ -254,20 +738,15 @@ def download_song(song_id):
     if song is None:
         return json_error("Мелодия с таким идентификатором не найдена")
 
-    temp_dir = app.config['TEMP_UPLOAD_URL']
-    if os.path.isdir(temp_dir) is False:
-        os.mkdir(temp_dir)
-
-    temp_file_path = f'{temp_dir}/{song.name}'
-
     s3_file_path = str(g.user.id) + "/" + song.name
     if request.method == 'GET':
-        result = s3_resource.Object(app.config['S3_BUCKET_NAME'], s3_file_path)\
-            .download_file(temp_file_path)
-        return send_file(os.path.abspath(temp_file_path), as_attachment=True)
+        if app.config['S3_DOWNLOAD_MODE'] == 'redirect':
+            return redirect(presigned_download_url(s3_file_path, song.name))
+        return stream_s3_file(s3_file_path, song.name)
 
     if request.method == 'DELETE':
-        s3_resource.Object(app.config['S3_BUCKET_NAME'], s3_file_path).delete()
+        storage.delete(s3_file_path)
+        storage.delete(preview_key(s3_file_path))
         Song.query.filter_by(id=song_id).delete()
         db.session.commit()
         return jsonify({}), 200
@@ -282,7 +761,7 @@ def get_public_songs():
     if not is_token_valid(request.headers.get("Authorization")):
         return abort(401)
     songs = Song.query.filter_by(is_public=True)
-    return jsonify([i.serialize for i in songs.all()])
+    return song_list_response(songs)
 
 
 @app.route('/api/songs/<song_id>/rate', methods=['POST'])
@@ -296,17 +775,13 @@ def rate_songs(song_id):
     if not request.args.get("score"):
         return json_error("Рейтинг не задан")
 
-    song_rating = SongRating.query.filter_by(song_id=song_id, user_id=g.user.id).first()
-
-    if song_rating is None:
-        song_rating = SongRating(song_id=song_id, user_id=g.user.id, rating=int(request.args.get("score")))
-    else:
-        song_rating.rating = request.args.get("score")
+    song = Song.query.filter_by(id=song_id).first()
+    if song is None:
+        return json_error("Мелодия с таким идентификатором не найдена")
 
-    db.session.add(song_rating)
+    Song.add_rating(song.id, g.user.id, int(request.args.get("score")))
     db.session.commit()
-
-    song = Song.query.filter_by(id=song_id).first()
+    db.session.refresh(song)
 
     return jsonify(song.serialize), 200
 
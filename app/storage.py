@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from collections import defaultdict
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+
+
+class S3Storage(object):
+    """
+    Работа с бакетом S3 для веб-приложения и воркеров celery.
+    У каждого потока свой клиент (сессии boto3 не потокобезопасны),
+    после fork клиенты создаются заново. Для каждой операции
+    считается количество вызовов, суммарное время и объем данных
+    """
+
+    def __init__(self, config):
+        self.bucket = config['S3_BUCKET_NAME']
+        self.presigned_expiration = config['S3_PRESIGNED_EXPIRATION']
+        self.client_config = BotoConfig(
+            max_pool_connections=config['S3_MAX_POOL_CONNECTIONS'],
+            connect_timeout=config['S3_CONNECT_TIMEOUT'],
+            read_timeout=config['S3_READ_TIMEOUT'],
+            retries={'max_attempts': config['S3_MAX_ATTEMPTS']}
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=config['S3_MULTIPART_THRESHOLD'],
+            multipart_chunksize=config['S3_MULTIPART_CHUNKSIZE'],
+            max_concurrency=config['S3_MAX_CONCURRENCY']
+        )
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._metrics = defaultdict(lambda: {'count': 0, 'errors': 0, 'time': 0.0, 'bytes': 0})
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            # Процесс форкнут, клиенты родителя использовать нельзя
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = boto3.session.Session().client('s3', config=self.client_config)
+            self._local.client = client
+        return client
+
+    def _timed(self, operation, call, size=0):
+        """
+        size - число байт или функция, которая посчитает его после вызова
+        """
+        start = time.time()
+        try:
+            result = call()
+        except Exception:
+            self._record(operation, time.time() - start, 0, error=True)
+            raise
+        self._record(operation, time.time() - start, size() if callable(size) else size)
+        return result
+
+    def _record(self, operation, elapsed, size, error=False):
+        with self._lock:
+            metric = self._metrics[operation]
+            metric['count'] += 1
+            metric['time'] += elapsed
+            metric['bytes'] += size
+            if error:
+                metric['errors'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {operation: dict(metric, time=round(metric['time'], 3))
+                    for operation, metric in self._metrics.items()}
+
+    # Операции
+
+    def upload_file(self, key, path):
+        return self._timed('upload', lambda: self.client.upload_file(
+            path, self.bucket, key, Config=self.transfer_config), os.path.getsize(path))
+
+    def upload_fileobj(self, key, fileobj):
+        # Объем считается по callback: после загрузки s3transfer может закрыть файл
+        sent = []
+        return self._timed('upload', lambda: self.client.upload_fileobj(
+            fileobj, self.bucket, key, Config=self.transfer_config, Callback=sent.append), lambda: sum(sent))
+
+    def download_fileobj(self, key, fileobj):
+        start = fileobj.tell()
+        return self._timed('download', lambda: self.client.download_fileobj(
+            self.bucket, key, fileobj, Config=self.transfer_config), lambda: fileobj.tell() - start)
+
+    def get_object(self, key, **params):
+        return self._timed('get', lambda: self.client.get_object(Bucket=self.bucket, Key=key, **params))
+
+    def head_object(self, key):
+        return self._timed('head', lambda: self.client.head_object(Bucket=self.bucket, Key=key))
+
+    def delete(self, key):
+        return self._timed('delete', lambda: self.client.delete_object(Bucket=self.bucket, Key=key))
+
+    def presigned_url(self, key, **params):
+        params.update(Bucket=self.bucket, Key=key)
+        return self._timed('presign', lambda: self.client.generate_presigned_url(
+            'get_object', Params=params, ExpiresIn=self.presigned_expiration))
+
+    def presigned_post(self, key, conditions=None):
+        return self._timed('presign', lambda: self.client.generate_presigned_post(
+            Bucket=self.bucket, Key=key, Conditions=conditions, ExpiresIn=self.presigned_expiration))
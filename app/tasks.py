@@ -0,0 +1,187 @@
+"""
+Задачи celery для обработки midi. Все, что тянет за собой music21,
+numpy и сети, импортируется только внутри задач и сигналов воркера,
+поэтому веб-процесс может импортировать этот модуль ради apply_async
+"""
+import gc
+import os
+import tempfile
+
+from celery.signals import task_prerun, task_postrun, worker_init, worker_process_init
+
+from app import app, db, celery, storage
+from app.models import SynthInfo
+from ml_models.cache import result_cache, file_digest
+
+
+@task_postrun.connect
+def close_session(*args, **kwargs):
+    with app.app_context():
+        db.session.remove()
+
+
+@task_prerun.connect
+def on_task_init(*args, **kwargs):
+    with app.app_context():
+        db.engine.dispose()
+
+
+@worker_init.connect
+def import_ml_stack(*args, **kwargs):
+    # Импортируем до fork, чтобы дочерние процессы не делали это каждый сам
+    import ml_models.model_processing  # noqa: F401
+
+
+@worker_process_init.connect
+def preload_models(*args, **kwargs):
+    if app.config['PRELOAD_MODELS']:
+        from ml_models.registry import registry
+        registry.preload()
+        print(f'Models preloaded: {registry.stats()}')
+
+
+def processing_task_id(synth_info_id):
+    """
+    id, под которым в result backend лежит статус обработки мелодии
+    (для мелодий из пачки его пишет process_midi_batch)
+    """
+    return f'synth-info-{synth_info_id}'
+
+
+def preview_key(result_key):
+    """
+    Ключ частичного результата потоковой обработки: под result_key
+    мелодия появляется только после успешной обработки
+    """
+    return f'{os.path.splitext(result_key)[0]}.preview.mid'
+
+
+def process_file(filename, genre, synth_info_id, user_id, s3_key=None, report=None):
+    """
+    Скачивает midi из временной папки S3, обрабатывает его и загружает результат.
+    report(stage, progress) вызывается на каждом этапе
+    """
+    from ml_models.model_processing import proc, OUTPUT_MODE, PIPELINE_STAGES, TOKENIZER_MODE
+
+    def report_stage(stage, progress):
+        if report is not None:
+            report(stage, progress)
+
+    def report_pipeline_stage(stage):
+        # Этапы обработки занимают прогресс от 0.1 до 0.9
+        index = PIPELINE_STAGES.index(stage)
+        report_stage(stage, round(0.1 + 0.8 * index / len(PIPELINE_STAGES), 2))
+
+    report_stage('download', 0)
+
+    # Downloading file from S3 temp dir into memory (spills to disk if too big)
+    temp_bucket_dir = app.config['S3_TEMP_DIR_NAME']
+    s3_file_path = s3_key or f'{temp_bucket_dir}/{filename}'
+    spool_size = app.config['WORKER_SPOOL_MAX_SIZE']
+
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as source:
+        storage.download_fileobj(s3_file_path, source)
+        source.seek(0)
+        storage.delete(s3_file_path)
+
+        # Same file with same genre and model was already processed
+        digest = file_digest(source)
+        cache_key = result_cache.output_key(digest, genre, TOKENIZER_MODE, OUTPUT_MODE)
+        cached_file = result_cache.get_output(cache_key)
+        result_key = str(user_id) + "/" + filename
+
+        if cached_file is not None:
+            print(f'Result for synthInfo {synth_info_id} found in cache')
+            report_stage('upload', 0.9)
+            storage.upload_file(result_key, cached_file)
+        else:
+            # Start processing file
+            previews = []
+
+            def upload_preview(writer):
+                # Partial result is available by its own key while processing goes on
+                with tempfile.SpooledTemporaryFile(max_size=spool_size) as preview:
+                    writer.write(preview)
+                    preview.seek(0)
+                    storage.upload_fileobj(preview_key(result_key), preview)
+                previews.append(writer.count)
+
+            with tempfile.SpooledTemporaryFile(max_size=spool_size) as processed:
+                proc(source, genre, digest=digest, output=processed,
+                     on_stage=report_pipeline_stage, on_preview=upload_preview)
+                result_cache.put_output(cache_key, processed)
+                # Upload on S3 processed file
+                report_stage('upload', 0.9)
+                storage.upload_fileobj(result_key, processed)
+            if previews:
+                storage.delete(preview_key(result_key))
+
+    # Saving info in DB
+    synth_info = SynthInfo.query.filter_by(id=synth_info_id).first()
+    synth_info.processing_complete = True
+    db.session.add(synth_info)
+    db.session.commit()
+
+    print(f'Processing of synthInfo {synth_info_id} is completed')
+
+
+# Имена задач остались от app.routes, чтобы задачи, уже стоящие в очереди, не потерялись
+@celery.task(bind=True, name='app.routes.process_midi_file')
+def process_midi_file(self, filename, genre, synth_info_id, user_id, s3_key=None):
+    def report(stage, progress):
+        if self.request.id:
+            self.update_state(state='PROGRESS', meta={'stage': stage, 'progress': progress})
+
+    from ml_models.registry import registry
+
+    with app.app_context():
+        gc.collect()
+        process_file(filename, genre, synth_info_id, user_id, s3_key, report)
+        print(f'Model registry: {registry.stats()}')
+        print(f'S3: {storage.stats()}')
+
+
+@celery.task(bind=True, name='app.routes.process_midi_batch')
+def process_midi_batch(self, items, genre, user_id):
+    """
+    Обрабатывает несколько файлов одного жанра подряд на одном воркере,
+    чтобы сеть загружалась один раз.
+    items - [(filename, synth_info_id, s3_key)]
+    """
+    from ml_models.registry import registry
+
+    failed = []
+    with app.app_context():
+        gc.collect()
+        for index, (filename, synth_info_id, s3_key) in enumerate(items):
+            song_task_id = processing_task_id(synth_info_id)
+
+            def report(stage, progress):
+                # Статус каждой мелодии пачки, как у отдельной задачи process_midi_file
+                self.backend.store_result(song_task_id, {'stage': stage, 'progress': progress}, 'PROGRESS')
+
+            if self.request.id:
+                self.update_state(state='PROGRESS',
+                                  meta={'done': index - len(failed), 'failed': len(failed), 'total': len(items)})
+            try:
+                process_file(filename, genre, synth_info_id, user_id, s3_key, report)
+                self.backend.mark_as_done(song_task_id, None)
+            except Exception as e:
+                print(f'Processing of synthInfo {synth_info_id} failed: {e}')
+                db.session.rollback()
+                self.backend.mark_as_failure(song_task_id, e)
+                failed.append(synth_info_id)
+
+        print(f'Model registry: {registry.stats()}')
+        print(f'S3: {storage.stats()}')
+    return {'done': len(items) - len(failed), 'failed': len(failed), 'total': len(items)}
+
+
+@celery.task(name='app.routes.process_midi_batch_done')
+def process_midi_batch_done(results):
+    """
+    Итог всей пачки после обработки всех ее частей
+    """
+    summary = {key: sum(result[key] for result in results) for key in ('done', 'failed', 'total')}
+    print(f'Batch processing is completed: {summary}')
+    return summary
@@ -0,0 +1,68 @@
+"""
+Сравнение create_midi (music21) и write_midi: время записи
+и совпадение нот в получившихся файлах.
+
+    python -m benchmarks.bench_midi_writer --notes 2000
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from benchmarks.fixtures import make_tokens
+from ml_models.midi_writer import write_midi
+from ml_models.model_processing import create_midi
+from ml_models.tokenizer import iter_midi_tracks
+
+
+def midi_notes(path):
+    """
+    Ноты файла в виде (program, начало в четвертях, нота)
+    """
+    with open(path, 'rb') as f:
+        ticks_per_quarter, tracks = iter_midi_tracks(f.read())
+
+    notes = []
+    for events in tracks:
+        programs = {}
+        for tick, status, data1, data2 in events:
+            kind, channel = status & 0xF0, status & 0x0F
+            if kind == 0xC0:
+                programs[channel] = data1
+            elif kind == 0x90 and data2 > 0:
+                notes.append((programs.get(channel, 0), round(tick / ticks_per_quarter, 3), data1))
+    return sorted(notes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, default=2000)
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.notes, tracks=3)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        old_path = os.path.join(temp_dir, 'music21.mid')
+        new_path = os.path.join(temp_dir, 'fast.mid')
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_midi(tokens, old_path)
+        old = time.time() - start
+
+        start = time.time()
+        write_midi(tokens, new_path)
+        new = time.time() - start
+
+        old_notes, new_notes = midi_notes(old_path), midi_notes(new_path)
+
+    print(f'tokens: {len(tokens)}')
+    print(f'create_midi: {old * 1000:10.1f} ms, notes: {len(old_notes)}')
+    print(f'write_midi:  {new * 1000:10.1f} ms, notes: {len(new_notes)}')
+    print(f'speedup: {old / new:.1f}x')
+    print('equal notes:', old_notes == new_notes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Бенчмарк всего proc(): время каждого этапа, пиковый RSS и нот в секунду
+на синтетических midi разной длины и с разным числом дорожек.
+
+По умолчанию вместо сети используется маленькая заглушка, словарь
+строится по самому короткому файлу. С --genre берется настоящая сеть.
+
+Сравнение двух ревизий:
+
+    git checkout <old> && python -m benchmarks.bench_proc --output old.json
+    git checkout <new> && python -m benchmarks.bench_proc --compare old.json --threshold 1.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.fixtures import make_midi
+
+# Как PIPELINE_STAGES в model_processing, здесь без импорта keras в основном процессе
+STAGES = ['tokenize', 'snap', 'encode', 'windows', 'predict', 'decode', 'write']
+CASES = [(500, 1), (2000, 1), (2000, 4), (8000, 4)]
+
+
+class StandInModel(object):
+    """
+    Заглушка вместо сети: детерминированные "вероятности"
+    такой же формы, как у настоящей модели
+    """
+
+    def __init__(self, vocab_size, seed=0):
+        rnd = np.random.RandomState(seed)
+        self.weights = rnd.rand(vocab_size, vocab_size).astype(np.float32)
+
+    def predict(self, batch, batch_size=None):
+        return batch.sum(axis=1).dot(self.weights)
+
+
+class StandInEncoder(object):
+    def __init__(self, classes):
+        self.classes_ = np.array(sorted(classes))
+
+
+def stand_in_bundle(vocab_file, look_back=2):
+    from ngram import NGram
+    from ml_models.model_processing import get_msg
+    from ml_models.registry import ModelBundle
+    from ml_models.vocab import VocabSnapper
+
+    encoder = StandInEncoder(set(get_msg(vocab_file)))
+    ngram = NGram(list(encoder.classes_))
+    return ModelBundle(genre='stand-in', model=StandInModel(len(encoder.classes_)), encoder=encoder,
+                       ngram=ngram, snapper=VocabSnapper(ngram, encoder.classes_), look_back=look_back)
+
+
+def run_case(midi, vocab_file, genre):
+    """
+    Выполняется в отдельном процессе, чтобы пиковый RSS был у каждого случая свой
+    """
+    from ml_models.model_processing import run_pipeline
+    from ml_models.registry import registry
+
+    bundle = registry.get(genre) if genre else stand_in_bundle(vocab_file)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    timings = {}
+    descriptor, output = tempfile.mkstemp(suffix='.mid')
+    os.close(descriptor)
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            notes = run_pipeline(midi, bundle, output, timings=timings)
+        total = time.perf_counter() - start
+    finally:
+        os.remove(output)
+
+    return {
+        'timings': timings,
+        'total': total,
+        'notes': len(notes),
+        'notes_per_second': len(notes) / total if total else 0,
+        'rss_before_mb': rss_before / 1024,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def print_results(results, baseline=None):
+    header = f'{"case":>12} ' + ' '.join(f'{s:>9}' for s in STAGES) + f' {"total":>9} {"notes/s":>9} {"peak MB":>8}'
+    print(header)
+    for case, result in results.items():
+        row = f'{case:>12} ' + ' '.join(f'{result["timings"].get(s, 0) * 1000:9.1f}' for s in STAGES)
+        row += f' {result["total"] * 1000:9.1f} {result["notes_per_second"]:9.0f} {result["peak_rss_mb"]:8.1f}'
+        if baseline and case in baseline:
+            row += f'  x{result["total"] / baseline[case]["total"]:.2f}'
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genre', help='настоящая сеть из genres.json вместо заглушки')
+    parser.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'music-synth-bench'))
+    parser.add_argument('--output', help='сохранить результаты в json')
+    parser.add_argument('--compare', help='json с результатами другой ревизии')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='код возврата 1, если какой-то случай медленнее базового в threshold раз')
+    args = parser.parse_args()
+
+    os.makedirs(args.fixtures, exist_ok=True)
+    vocab_file = make_midi(args.fixtures, *CASES[0])
+
+    results = {}
+    for notes, tracks in CASES:
+        midi = make_midi(args.fixtures, notes, tracks)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[f'{notes}x{tracks}'] = executor.submit(run_case, midi, vocab_file, args.genre).result()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print('times in ms')
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline and args.threshold:
+        slower = [case for case in results
+                  if case in baseline and results[case]['total'] > baseline[case]['total'] * args.threshold]
+        if slower:
+            print('Slower than baseline:', ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
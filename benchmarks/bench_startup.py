@@ -0,0 +1,102 @@
+"""
+Время запуска и RSS веб-процесса и воркера celery. Каждый замер делается
+в новом интерпретаторе: web - импорт music-synth.py (как gunicorn),
+worker - импорт app и сигнал worker_init (как celery -A app.celery),
+с --preload еще и загрузка сетей из genres.json.
+
+    python -m benchmarks.bench_startup --output old.json
+    python -m benchmarks.bench_startup --compare old.json --threshold 1.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import runpy
+import subprocess
+import sys
+import time
+
+ROLES = ['web', 'worker']
+# Модули, которых не должно быть в веб-процессе
+HEAVY_MODULES = ['tensorflow', 'keras', 'music21', 'sklearn', 'numpy', 'ngram']
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(role, preload=False):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if role == 'web':
+            runpy.run_path(os.path.join(ROOT, 'music-synth.py'))
+        else:
+            from app.tasks import import_ml_stack
+            import_ml_stack()
+            if preload:
+                from ml_models.registry import registry
+                registry.preload()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'time': elapsed,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+        'modules': len(sys.modules)
+    }
+
+
+def run_role(role, preload):
+    command = [sys.executable, '-m', 'benchmarks.bench_startup', '--role', role]
+    if preload:
+        command.append('--preload')
+    output = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--role', choices=ROLES, help='один замер в этом процессе, результат в json')
+    parser.add_argument('--preload', action='store_true', help='для worker: загрузить сети')
+    parser.add_argument('--repeat', type=int, default=3, help='берется лучший из нескольких запусков')
+    parser.add_argument('--output', help='сохранить результаты в json')
+    parser.add_argument('--compare', help='json с результатами другой ревизии')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='код возврата 1, если какая-то роль запускается медленнее базовой в threshold раз')
+    args = parser.parse_args()
+
+    if args.role:
+        print(json.dumps(measure(args.role, args.preload)))
+        return
+
+    results = {}
+    for role in ROLES:
+        runs = [run_role(role, args.preload) for _ in range(args.repeat)]
+        results[role] = min(runs, key=lambda run: run['time'])
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print(f'{"role":>8} {"time ms":>9} {"RSS MB":>8} {"modules":>8}  heavy modules')
+    for role, result in results.items():
+        row = f'{role:>8} {result["time"] * 1000:9.1f} {result["rss_mb"]:8.1f} {result["modules"]:8d}  '
+        row += ', '.join(result['heavy_modules']) or '-'
+        if baseline and role in baseline:
+            row += f'  x{result["time"] / baseline[role]["time"]:.2f}'
+        print(row)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline and args.threshold:
+        slower = [role for role in results
+                  if role in baseline and results[role]['time'] > baseline[role]['time'] * args.threshold]
+        if slower:
+            print('Slower than baseline:', ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
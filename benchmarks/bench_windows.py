@@ -0,0 +1,52 @@
+"""
+Сравнение create_dataset и window_dataset.
+
+    python -m benchmarks.bench_windows --length 20000 --vocab 839 --look-back 2
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from ml_models.model_processing import create_dataset
+from ml_models.windows import window_dataset
+
+
+def make_data(length, vocab, one_hot):
+    ids = np.random.randint(0, vocab, size=length).astype(np.int32)
+    if not one_hot:
+        return ids
+    data = np.zeros((length, vocab), dtype=np.int64)
+    data[np.arange(length), ids] = 1
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--length', type=int, default=20000)
+    parser.add_argument('--vocab', type=int, default=839)
+    parser.add_argument('--look-back', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--one-hot', action='store_true',
+                        help='окна по one-hot матрице, как в старом proc()')
+    args = parser.parse_args()
+
+    data = make_data(args.length, args.vocab, args.one_hot)
+
+    X_old, Y_old = create_dataset(data, args.look_back)
+    X_new, Y_new = window_dataset(data, args.look_back)
+    assert np.array_equal(X_old, X_new) and np.array_equal(Y_old, Y_new)
+
+    old = min(timeit.repeat(lambda: create_dataset(data, args.look_back),
+                            number=1, repeat=args.repeat))
+    new = min(timeit.repeat(lambda: window_dataset(data, args.look_back),
+                            number=1, repeat=args.repeat))
+
+    print(f'data: {data.shape} {data.dtype}, look_back={args.look_back}')
+    print(f'create_dataset: {old * 1000:10.3f} ms, X: {X_old.nbytes / 2 ** 20:8.2f} MB')
+    print(f'window_dataset: {new * 1000:10.3f} ms, X: view on {data.nbytes / 2 ** 20:8.2f} MB')
+    print(f'speedup: {old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
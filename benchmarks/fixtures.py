@@ -0,0 +1,33 @@
+"""
+Синтетические midi для бенчмарков, генерируются локально
+"""
+import os
+import random
+
+from ml_models.midi_writer import write_midi
+
+PITCHES = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+OFFSETS = ['0', '0.5', '1', '1.5', '2']
+INSTRUMENTS = ['Piano', 'Guitar', 'Horn', 'Violin', 'Flute', 'Organ', 'Saxophone', 'Trumpet']
+
+
+def make_tokens(count, tracks=1, seed=0):
+    rnd = random.Random(seed)
+    instruments = INSTRUMENTS[:tracks]
+    tokens = []
+    for _ in range(count):
+        inst = rnd.choice(instruments)
+        if rnd.random() < 0.3:
+            chord = sorted(rnd.sample(range(12), 3))
+            tokens.append('.'.join(map(str, chord)) + '|' + rnd.choice(OFFSETS) + '|' + inst)
+        else:
+            octave = rnd.randint(2, 6)
+            tokens.append(f'{rnd.choice(PITCHES)}{octave}|{rnd.choice(OFFSETS)}|{octave}|{inst}')
+    return tokens
+
+
+def make_midi(directory, notes, tracks=1, seed=0):
+    path = os.path.join(directory, f'synthetic_{notes}_{tracks}.mid')
+    if not os.path.isfile(path):
+        write_midi(make_tokens(notes, tracks, seed), path)
+    return path
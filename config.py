@@ -6,9 +6,59 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = 'myverysecretlooooooooooongkey'
+    # Сколько секунд проверенный токен не проверяется повторно по базе
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 60))
+    TOKEN_CACHE_SIZE = 10000
     TEMP_UPLOAD_URL = './temp'
     S3_TEMP_DIR_NAME = 'temp'
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 20))
+    S3_CONNECT_TIMEOUT = 5
+    S3_READ_TIMEOUT = 60
+    S3_MAX_ATTEMPTS = 3
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', 4))
+    # stream - файл отдается через приложение кусками, redirect - presigned url на S3
+    S3_DOWNLOAD_MODE = os.environ.get('S3_DOWNLOAD_MODE', 'stream')
+    S3_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    S3_PRESIGNED_EXPIRATION = 300
+    S3_UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+    SONGS_PAGE_SIZE = 20
+    SONGS_MAX_PAGE_SIZE = 100
     S3_BUCKET_NAME = os.environ.get('S3_BUCKET', 'music-synth-backend')
     CELERY_BROKER_URL = os.environ.get('REDISCLOUD_URL') or 'redis://localhost:6379'
-    CELERYD_MAX_TASKS_PER_CHILD = 1
+    # Сети держатся в памяти воркера между задачами, поэтому процесс
+    # перезапускается не после каждой задачи
+    CELERYD_MAX_TASKS_PER_CHILD = int(os.environ.get('CELERYD_MAX_TASKS_PER_CHILD', 100))
+    # midi меньше этого размера обрабатываются воркером целиком в памяти
+    WORKER_SPOOL_MAX_SIZE = int(os.environ.get('WORKER_SPOOL_MAX_SIZE', 16 * 1024 * 1024))
+    PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', '1') == '1'
     CELERY_RESULT_BACKEND = os.environ.get('REDISCLOUD_URL') or 'redis://localhost:6379'
+    CELERY_TRACK_STARTED = True
+    # Обработка идет в очереди <queue>.small и <queue>.large, см. Procfile
+    PROCESSING_QUEUE = 'midi'
+    PROCESSING_LARGE_FILE_SIZE = int(os.environ.get('PROCESSING_LARGE_FILE_SIZE', 64 * 1024))
+    # Жанры, которые обрабатываются на отдельных воркерах: {'Classic': 'classic'}
+    PROCESSING_GENRE_QUEUES = {}
+    # Не больше PROCESSING_RATE_LIMIT мелодий от юзера за PROCESSING_RATE_WINDOW секунд
+    PROCESSING_RATE_LIMIT = int(os.environ.get('PROCESSING_RATE_LIMIT', 10))
+    PROCESSING_RATE_WINDOW = 60
+    BATCH_MAX_FILES = 100
+    BATCH_CHUNK_SIZE = 10
+    # Максимальный размер одной мелодии из zip архива пачки (по заголовку архива)
+    BATCH_MAX_FILE_SIZE = 10 * 1024 * 1024
+    # Не больше BATCH_RATE_LIMIT мелодий в пачках от юзера за BATCH_RATE_WINDOW секунд
+    BATCH_RATE_LIMIT = int(os.environ.get('BATCH_RATE_LIMIT', 2 * BATCH_MAX_FILES))
+    BATCH_RATE_WINDOW = 60 * 60
+    # Как часто SSE поток статуса проверяет result backend и сколько секунд живет
+    # (--timeout gunicorn в Procfile должен быть больше)
+    STATUS_STREAM_INTERVAL = 0.5
+    STATUS_STREAM_TIMEOUT = 600
+    # Сколько SSE потоков статуса держит один процесс gunicorn: каждый занимает
+    # поток gthread, и без лимита они заняли бы все WEB_THREADS.
+    # Сверх лимита поток отвечает 503, клиент опрашивает /status
+    STATUS_STREAM_MAX = int(os.environ.get('STATUS_STREAM_MAX', int(os.environ.get('WEB_THREADS', 8)) // 2))
+    STATUS_STREAM_RETRY_AFTER = 5
+    # Токен для SSE потока статуса одной мелодии передается в url,
+    # поэтому он короткий и нужен только для открытия соединения
+    STATUS_STREAM_TOKEN_TTL = 60
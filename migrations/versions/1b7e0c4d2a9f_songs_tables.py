@@ -0,0 +1,71 @@
+"""songs tables
+
+Revision ID: 1b7e0c4d2a9f
+Revises: a85e550c9a5a
+Create Date: 2026-10-18 15:21:08.104218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b7e0c4d2a9f'
+down_revision = 'a85e550c9a5a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Before this revision the tables were created by db.create_all() on app import,
+    # so on existing databases only what is missing is created
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if 'create_date' not in [column['name'] for column in inspector.get_columns('user')]:
+        op.add_column('user', sa.Column('create_date', sa.DateTime(), nullable=True))
+        op.create_index(op.f('ix_user_create_date'), 'user', ['create_date'], unique=False)
+
+    if 'synth_info' not in tables:
+        op.create_table('synth_info',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('raw_song_id', sa.Integer(), nullable=True),
+        sa.Column('song_id', sa.Integer(), nullable=True),
+        sa.Column('processing_complete', sa.Boolean(), nullable=True),
+        sa.Column('genre', sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'song' not in tables:
+        op.create_table('song',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('create_date', sa.DateTime(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('is_public', sa.Boolean(), nullable=True),
+        sa.Column('synth_info_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['synth_info_id'], ['synth_info.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_song_create_date'), 'song', ['create_date'], unique=False)
+        op.create_index(op.f('ix_song_name'), 'song', ['name'], unique=True)
+
+    if 'song_rating' not in tables:
+        op.create_table('song_rating',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('song_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('rating', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('song_rating')
+    op.drop_index(op.f('ix_song_name'), table_name='song')
+    op.drop_index(op.f('ix_song_create_date'), table_name='song')
+    op.drop_table('song')
+    op.drop_table('synth_info')
+    op.drop_index(op.f('ix_user_create_date'), table_name='user')
+    op.drop_column('user', 'create_date')
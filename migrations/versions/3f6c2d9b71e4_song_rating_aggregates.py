@@ -0,0 +1,48 @@
+"""song rating aggregates
+
+Revision ID: 3f6c2d9b71e4
+Revises: 1b7e0c4d2a9f
+Create Date: 2026-10-18 12:04:37.512930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6c2d9b71e4'
+down_revision = '1b7e0c4d2a9f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Tables created by db.create_all() after the model change already have the columns
+    columns = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('song')]
+    if 'rating_count' not in columns:
+        op.add_column('song', sa.Column('rating_count', sa.Integer(), nullable=False, server_default='0'))
+    if 'rating_sum' not in columns:
+        op.add_column('song', sa.Column('rating_sum', sa.Integer(), nullable=False, server_default='0'))
+
+    # One rating per user and song, keep the latest one
+    op.execute(
+        'DELETE FROM song_rating WHERE id NOT IN '
+        '(SELECT MAX(id) FROM song_rating GROUP BY song_id, user_id)'
+    )
+    indexes = [index['name'] for index in sa.inspect(op.get_bind()).get_indexes('song_rating')]
+    if 'ix_song_rating_song_id_user_id' in indexes:
+        op.drop_index('ix_song_rating_song_id_user_id', table_name='song_rating')
+    op.create_index('ix_song_rating_song_id_user_id', 'song_rating', ['song_id', 'user_id'], unique=True)
+
+    # Backfill from existing ratings, same as `flask backfill-ratings`
+    op.execute(
+        'UPDATE song SET '
+        'rating_count = (SELECT COUNT(*) FROM song_rating WHERE song_rating.song_id = song.id), '
+        'rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM song_rating WHERE song_rating.song_id = song.id)'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_song_rating_song_id_user_id', table_name='song_rating')
+    op.drop_column('song', 'rating_sum')
+    op.drop_column('song', 'rating_count')
@@ -0,0 +1,26 @@
+"""synth info task id
+
+Revision ID: 7c41e9a0d5b3
+Revises: 3f6c2d9b71e4
+Create Date: 2026-10-18 16:02:44.318590
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c41e9a0d5b3'
+down_revision = '3f6c2d9b71e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('synth_info', sa.Column('task_id', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_synth_info_task_id'), 'synth_info', ['task_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_synth_info_task_id'), table_name='synth_info')
+    op.drop_column('synth_info', 'task_id')
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+from ml_models.genres import load_manifest
+
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', './temp/cache')
+# Максимальный размер кеша на диске, по умолчанию 512 МБ
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+def file_digest(file):
+    """
+    SHA-256 содержимого midi: путь, байты или файловый объект
+    """
+    sha = hashlib.sha256()
+    if isinstance(file, (bytes, bytearray)):
+        sha.update(file)
+    elif hasattr(file, 'read'):
+        position = file.tell()
+        for block in iter(lambda: file.read(1 << 16), b''):
+            sha.update(block)
+        file.seek(position)
+    else:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Кеш токенов и готовых midi на локальном диске по хешу содержимого.
+    Давно не использованные файлы удаляются, когда кеш больше max_bytes
+    """
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._manifest = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def model_version(self, genre):
+        if self._manifest is None:
+            self._manifest = load_manifest()
+        return str(self._manifest.get(genre, {}).get('version', 0))
+
+    def output_key(self, digest, genre, tokenizer_mode, mode=''):
+        # Результат зависит от версии сети из genres.json и от того, как разобран midi
+        key = f'{digest}_{genre}_v{self.model_version(genre)}_{tokenizer_mode}'
+        return f'{key}_{mode}' if mode else key
+
+    def get_output(self, key):
+        path = self._path(key + '.mid')
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(path)
+        return path
+
+    def put_output(self, key, file):
+        """
+        file - путь или файловый объект (его позиция не меняется)
+        """
+        path = self._path(key + '.mid')
+        if not hasattr(file, 'read'):
+            self._write(path, lambda temp_path: shutil.copyfile(file, temp_path))
+            return path
+
+        def write(temp_path):
+            position = file.tell()
+            with open(temp_path, 'wb') as f:
+                shutil.copyfileobj(file, f)
+            file.seek(position)
+
+        self._write(path, write)
+        return path
+
+    def get_tokens(self, digest, mode):
+        tokens = self.iter_tokens(digest, mode)
+        return None if tokens is None else list(tokens)
+
+    def iter_tokens(self, digest, mode):
+        """
+        Токены из кеша по одному, не читая файл целиком (None, если их нет)
+        """
+        try:
+            f = open(self._path(f'{digest}_{mode}.tokens'))
+        except FileNotFoundError:
+            return None
+        os.utime(f.name)
+
+        def lines():
+            with f:
+                for line in f:
+                    yield line.rstrip('\n')
+        return lines()
+
+    def put_tokens(self, digest, mode, tokens):
+        with self.token_writer(digest, mode) as f:
+            for token in tokens:
+                f.write(token + '\n')
+
+    @contextmanager
+    def token_writer(self, digest, mode):
+        """
+        Файл, в который токены пишутся по одному, по строке на токен.
+        В кеш он попадает, только если блок with завершился без ошибок
+        """
+        path = self._path(f'{digest}_{mode}.tokens')
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                yield f
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        os.replace(temp_path, path)
+        self._evict()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self._size()}
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _write(self, path, write):
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        write(temp_path)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _size(self):
+        if not os.path.isdir(self.root):
+            return 0
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+result_cache = ResultCache()
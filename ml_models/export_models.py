@@ -0,0 +1,62 @@
+"""
+Экспорт сетей из ml_models/models в .npz для MODEL_RUNTIME=numpy
+и проверка, что numpy runtime предсказывает то же, что Keras.
+
+    python -m ml_models.export_models [--genre Classic] [--windows 2000]
+"""
+import argparse
+import sys
+
+import numpy as np
+from keras.models import load_model
+
+from ml_models.genres import load_manifest
+from ml_models.numpy_runtime import NumpyModel, export_model
+
+
+def compare(keras_model, numpy_model, look_back, vocab_size, windows, seed=0):
+    """
+    Прогоняет одни и те же окна через обе сети, возвращает
+    максимальную разницу вероятностей и долю совпавших argmax
+    """
+    ids = np.random.RandomState(seed).randint(0, vocab_size, size=(windows, look_back)).astype(np.int32)
+    x = np.zeros(ids.shape + (vocab_size,), dtype=np.float32)
+    x.reshape(-1, vocab_size)[np.arange(ids.size), ids.ravel()] = 1
+
+    expected = keras_model.predict(x, batch_size=512)
+    dense = numpy_model.predict(x, batch_size=512)
+    by_ids = numpy_model.predict_ids(ids)
+
+    diff = max(np.abs(expected - dense).max(), np.abs(expected - by_ids).max())
+    agreement = np.mean(np.argmax(expected, axis=-1) == np.argmax(by_ids, axis=-1))
+    return diff, agreement
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genre', action='append', help='по умолчанию все жанры из genres.json')
+    parser.add_argument('--windows', type=int, default=2000, help='сколько окон сравнивать с Keras')
+    parser.add_argument('--tolerance', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    manifest = load_manifest()
+    failed = []
+    for genre in args.genre or sorted(manifest):
+        info = manifest[genre]
+        keras_model = load_model(info['model'])
+        export_model(keras_model, info['numpy_model'])
+        numpy_model = NumpyModel.load(info['numpy_model'])
+
+        diff, agreement = compare(keras_model, numpy_model, info.get('look_back', 2),
+                                  info.get('vocab_size', numpy_model.vocab_size), args.windows)
+        print(f'{genre}: {info["numpy_model"]}, max diff {diff:.2e}, argmax agreement {agreement:.4f}')
+        if diff > args.tolerance:
+            failed.append(genre)
+
+    if failed:
+        print(f'numpy runtime does not match Keras for: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import json
+import os
+
+ML_MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_PATH = os.path.join(ML_MODELS_DIR, 'genres.json')
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """
+    Читает манифест жанров: для каждого жанра пути до сети (.h5 и .npz), энкодера
+    и ngram (относительно ml_models), look_back, размер словаря и версию сети
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+
+    for genre, info in manifest.items():
+        info.setdefault('numpy_model', os.path.splitext(info['model'])[0] + '.npz')
+        for key in ('model', 'numpy_model', 'encoder', 'ngram'):
+            info[key] = os.path.join(ML_MODELS_DIR, info[key])
+    return manifest
+
+
+def get_genres(path=MANIFEST_PATH):
+    return sorted(load_manifest(path).keys())
@@ -0,0 +1,171 @@
+import io
+import shutil
+import struct
+import tempfile
+from functools import lru_cache
+
+from music21 import instrument
+
+# Как у music21 при записи midi
+TICKS_PER_QUARTER = 1024
+TEMPO = 500000  # 120 bpm
+VELOCITY = 60
+DRUM_CHANNEL = 9
+END_OF_TRACK = b'\x00\xff\x2f\x00'
+# Сколько байт событий дорожки держим в памяти до сброса на диск
+TRACK_SPOOL_SIZE = 1024 * 1024
+
+PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+# Названия из токенов, которые не совпадают с классами music21
+INSTRUMENT_ALIASES = {
+    'Voice': 'Vocalist',
+    'Brass': 'BrassInstrument',
+}
+
+
+def instrument_class_name(name):
+    if not name:
+        return 'Piano'
+    name = ''.join(name.split(' '))
+    return INSTRUMENT_ALIASES.get(name, name)
+
+
+@lru_cache(maxsize=None)
+def instrument_program(name):
+    """
+    Номер программы midi и признак ударных для инструмента music21
+    """
+    inst = getattr(instrument, name)()
+    program = inst.midiProgram or 0
+    return program, isinstance(inst, instrument.UnpitchedPercussion) or inst.midiChannel == DRUM_CHANNEL
+
+
+def note_to_midi(pattern, octave):
+    """
+    C#4, E-5 -> номер ноты midi; octave из токена важнее октавы в названии
+    """
+    name = pattern.rstrip('0123456789')
+    pitch_class = PITCH_CLASSES[name[0].upper()] + name.count('#') - name.count('-')
+    try:
+        octave = int(octave)
+    except ValueError:
+        octave = int(pattern[len(name):] or 4)
+    return (octave + 1) * 12 + pitch_class
+
+
+def _var_len(value):
+    result = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        result.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return result
+
+
+class _Track(object):
+    def __init__(self, channel, program, spool_size):
+        self.channel = channel
+        # События дорожки копятся в файле, который уходит на диск, если становится большим
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.length = 0
+        self.last_tick = 0
+        self.time = 0
+        self.event(0, 0xC0 | channel, program)
+
+    def event(self, tick, *data):
+        event = _var_len(tick - self.last_tick) + bytes(data)
+        self.buffer.write(event)
+        self.length += len(event)
+        self.last_tick = tick
+
+    def add(self, pitches):
+        # Как Part.append в music21: элементы идут друг за другом
+        # с длительностью в одну четверть
+        start, end = self.time, self.time + TICKS_PER_QUARTER
+        for pitch in pitches:
+            self.event(start, 0x90 | self.channel, pitch, VELOCITY)
+        for pitch in pitches:
+            self.event(end, 0x80 | self.channel, pitch, 0)
+        self.time = end
+
+    def write(self, f):
+        f.write(b'MTrk' + struct.pack('>I', self.length + len(END_OF_TRACK)))
+        self.buffer.seek(0)
+        shutil.copyfileobj(self.buffer, f)
+        self.buffer.seek(0, io.SEEK_END)
+        f.write(END_OF_TRACK)
+
+    def close(self):
+        self.buffer.close()
+
+
+class MidiWriter(object):
+    """
+    Пишет midi из токенов напрямую в байты, без music21 stream.
+    Результат совпадает с create_midi: по дорожке на инструмент,
+    ноты и аккорды по четверти друг за другом.
+    Токены можно добавлять частями и сохранять промежуточный результат
+    """
+
+    def __init__(self, spool_size=TRACK_SPOOL_SIZE):
+        self.spool_size = spool_size
+        self.tracks = {}
+        self.count = 0
+        self._channels = (c for c in range(16) if c != DRUM_CHANNEL)
+
+    def add(self, prediction_output):
+        for pattern in prediction_output:
+            s = pattern.split("|")
+            try:
+                float(s[1])
+                octave = s[2]
+            except (ValueError, IndexError):
+                print("error", pattern)
+                continue
+
+            inst = instrument_class_name(s[3] if len(s) > 3 else '')
+            track = self.tracks.get(inst)
+            if track is None:
+                program, is_drum = instrument_program(inst)
+                track = _Track(DRUM_CHANNEL if is_drum else next(self._channels, 15), program, self.spool_size)
+                self.tracks[inst] = track
+
+            pattern = s[0]
+            if ('.' in pattern) or pattern.isdigit():
+                track.add([60 + int(n) for n in pattern.split('.')])
+            else:
+                track.add([note_to_midi(pattern, octave)])
+            self.count += 1
+
+    def write(self, fp):
+        """
+        Сохраняет все добавленные ноты, fp - путь или файловый объект
+        """
+        if not hasattr(fp, 'write'):
+            with open(fp, 'wb') as f:
+                return self.write(f)
+
+        conductor = b'\x00\xff\x51\x03' + TEMPO.to_bytes(3, 'big') + b'\x00\xff\x58\x04\x04\x02\x18\x08'
+        conductor += END_OF_TRACK
+
+        fp.write(b'MThd' + struct.pack('>IHHH', 6, 1, len(self.tracks) + 1, TICKS_PER_QUARTER))
+        fp.write(b'MTrk' + struct.pack('>I', len(conductor)) + conductor)
+        for track in self.tracks.values():
+            track.write(fp)
+
+    def close(self):
+        for track in self.tracks.values():
+            track.close()
+
+
+def write_midi(prediction_output, fp):
+    """
+    Пишет midi из токенов за один раз, fp - путь или файловый объект
+    """
+    writer = MidiWriter()
+    try:
+        writer.add(prediction_output)
+        writer.write(fp)
+    finally:
+        writer.close()
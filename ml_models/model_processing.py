@@ -1,78 +1,80 @@
-from keras.models import load_model
-from music21 import converter, instrument, note, chord, stream
+from music21 import instrument, note, chord, stream, midi
 import numpy as np
 import os
 from heapq import nlargest
 import operator
 from tqdm import tqdm
 import glob
-from music21.ext import joblib
-from sklearn.preprocessing import LabelBinarizer
+import io
+import time
+from contextlib import contextmanager
+from itertools import islice
+from ml_models.registry import registry
+from ml_models.windows import window_dataset
+from ml_models.tokenizer import iter_tokens
+from ml_models.midi_writer import write_midi, MidiWriter
+from ml_models.cache import result_cache
 
+# Сколько окон прогоняем через сеть за один вызов predict
+PREDICT_BATCH_SIZE = int(os.environ.get('PREDICT_BATCH_SIZE', 512))
+# music21 - разбор через music21 stream, events - напрямую по событиям midi
+TOKENIZER_MODE = os.environ.get('MIDI_TOKENIZER', 'music21')
+# music21 - create_midi через music21 stream, events - write_midi напрямую в байты
+WRITER_MODE = os.environ.get('MIDI_WRITER', 'music21')
+# Потоковая обработка кусками по STREAM_CHUNK_SIZE нот, результат пишется через MidiWriter.
+# Когда готово STREAM_PREVIEW_EVERY нот, вызывается on_preview, потом каждый раз,
+# когда нот стало вдвое больше (0 - не вызывается)
+STREAMING_GENERATION = os.environ.get('STREAMING_GENERATION', '0') == '1'
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1024))
+STREAM_PREVIEW_EVERY = int(os.environ.get('STREAM_PREVIEW_EVERY', 0))
+# remake - сеть переделывает мелодию окно за окном (как раньше),
+# extend - дописывает CONTINUATION_LENGTH своих нот после оригинала,
+# continue - только новые ноты без оригинала
+GENERATION_MODE = os.environ.get('GENERATION_MODE', 'remake')
+CONTINUATION_LENGTH = int(os.environ.get('CONTINUATION_LENGTH', 256))
+# 0 - всегда самая вероятная нота, больше 1 - разнообразнее
+CONTINUATION_TEMPERATURE = float(os.environ.get('CONTINUATION_TEMPERATURE', 1.0))
+# Выбираем только из top_k самых вероятных нот (0 - из всех)
+CONTINUATION_TOP_K = int(os.environ.get('CONTINUATION_TOP_K', 0))
+# Каким способом получен результат (для ключа кеша): потоковая обработка пишет как 'events'
+OUTPUT_MODE = 'events' if STREAMING_GENERATION and GENERATION_MODE == 'remake' else WRITER_MODE
+if GENERATION_MODE != 'remake':
+    OUTPUT_MODE += f'_{GENERATION_MODE}{CONTINUATION_LENGTH}_t{CONTINUATION_TEMPERATURE}_k{CONTINUATION_TOP_K}'
 
-def get_msg(file):
-    notes = []
-    n = 0
+
+def iter_msg(file, mode=None):
     try:
-        midi = converter.parse(file)
-        notes_to_parse = None
-        parts = instrument.partitionByInstrument(midi)
-        if not parts:
-            print("NOT PARTS")
-            notes_to_parse = midi.flat.notes
-            prev_offset = 0
-            for element in notes_to_parse:
-                new_offset = 0.5
-                if prev_offset == element.offset:
-                    new_offset = 0
-                else:
-                    new_offset = element.offset - prev_offset
-                    if 0 < new_offset <= 0.5:
-                        new_offset = 0.5
-                    if 0.5 < new_offset <= 1:
-                        new_offset = 1
-
-                    if 1 < new_offset <= 1.5:
-                        new_offset = 1.5
-                    if 1.5 < new_offset:
-                        new_offset = 2
-                if isinstance(element, note.Note):
-                    notes.append(str(element.pitch) + "|" + str(new_offset) + "|" + str(element.octave))
-                    n += 1
-                elif isinstance(element, chord.Chord):
-                    notes.append('.'.join(str(n) for n in element.normalOrder) + "|" + str(new_offset))
-                    n += 1
-        else:
-            prev_offset = 0
-            for elem in parts:
-                notes_to_parse = elem.recurse()
-                for element in notes_to_parse:
-                    new_offset = 0.5
-                    if prev_offset == element.offset:
-                        new_offset = 0
-                    else:
-                        new_offset = element.offset - prev_offset
-                        if 0 < new_offset <= 0.5:
-                            new_offset = 0.5
-                        if 0.5 < new_offset <= 1:
-                            new_offset = 1
-
-                        if 1 < new_offset <= 1.5:
-                            new_offset = 1.5
-                        if 1.5 < new_offset:
-                            new_offset = 2
-                    if isinstance(element, note.Note):
-                        notes.append(str(element.pitch) + "|" + str(new_offset) + "|" + str(element.octave)
-                                     + "|" + str(elem[0]))
-                        n += 1
-                    elif isinstance(element, chord.Chord):
-                        notes.append('.'.join(str(n) for n in element.normalOrder) + "|" + str(new_offset)
-                                     + "|" + str(elem[0]))
-                        n += 1
-
-                    prev_offset = element.offset
+        for token in iter_tokens(file, mode or TOKENIZER_MODE):
+            yield token
+    except Exception as e:
+        print("Что - то не так: ", e)
+
+
+def get_msg(file, mode=None):
+    return list(iter_msg(file, mode))
+
+
+def iter_cached_msg(file, digest):
+    """
+    Токены по одному, как iter_msg. Они сразу дописываются в файл кеша,
+    который сохраняется, только когда midi разобран без ошибок
+    """
+    try:
+        with result_cache.token_writer(digest, TOKENIZER_MODE) as cached:
+            for token in iter_tokens(file, TOKENIZER_MODE):
+                cached.write(token + '\n')
+                yield token
     except Exception as e:
         print("Что - то не так: ", e)
+
+
+def get_cached_msg(file, digest=None):
+    if digest is None:
+        return get_msg(file)
+
+    notes = result_cache.get_tokens(digest, TOKENIZER_MODE)
+    if notes is None:
+        notes = list(iter_cached_msg(file, digest))
     return notes
 
 
@@ -158,7 +160,10 @@ def create_midi(prediction_output, name):
 
     midi_stream = stream.Stream(output_notes)
     midi_stream.show("text")
-    midi_stream.write('midi', fp=name)
+    if hasattr(name, 'write'):
+        name.write(midi.translate.streamToMidiFile(midi_stream).writestr())
+    else:
+        midi_stream.write('midi', fp=name)
 
 
 def extended_this(model, trainX, trainY, look_back):
@@ -190,57 +195,295 @@ def extended_this(model, trainX, trainY, look_back):
     return new_Y
 
 
-def proc(midi, genre):
-    notes = []
-    print("Start processing script for file path: " + midi)
-    print("Current dir content: ")
-    print(os.listdir('.'), sep='\n')
-    print("Temp dir:")
-    print(*glob.glob('./temp'), sep='\n')
-    notes.extend(get_msg(midi))
+def one_hot(ids, vocab_size):
+    """
+    One-hot для массива индексов нот любой формы (float32, как вход сети)
+    """
+    result = np.zeros(ids.shape + (vocab_size,), dtype=np.float32)
+    result.reshape(-1, vocab_size)[np.arange(ids.size), ids.ravel()] = 1
+    return result
+
+
+def predict_batched(model, trainX, batch_size=PREDICT_BATCH_SIZE, vocab_size=None):
+    """
+    Прогоняет весь trainX через сеть кусками по batch_size
+    и возвращает индексы самых вероятных нот (аналог extended_this,
+    но без вызова predict_proba на каждое окно).
+    Если задан vocab_size, trainX - окна из индексов нот, и one-hot
+    строится только для текущего куска
+    """
+    if len(trainX) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    indexes = []
+    for start in range(0, len(trainX), batch_size):
+        batch = trainX[start:start + batch_size]
+        if vocab_size is not None and hasattr(model, 'predict_ids'):
+            # numpy runtime берет индексы нот без one-hot
+            probs = model.predict_ids(batch)
+            indexes.append(np.argmax(probs, axis=-1))
+            continue
+        if vocab_size is not None:
+            batch = one_hot(batch, vocab_size)
+        probs = model.predict(batch, batch_size=len(batch))
+        indexes.append(np.argmax(probs, axis=-1))
+    return np.concatenate(indexes)
+
+
+def sample_next(probs, temperature=CONTINUATION_TEMPERATURE, top_k=CONTINUATION_TOP_K, rng=np.random):
+    """
+    Индекс следующей ноты по вероятностям сети
+    """
+    if temperature <= 0:
+        return int(np.argmax(probs))
+
+    logits = np.log(np.maximum(probs, 1e-12)) / temperature
+    if 0 < top_k < len(logits):
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+    else:
+        candidates = np.arange(len(logits))
+    weights = np.exp(logits[candidates] - logits[candidates].max())
+    return int(candidates[rng.choice(len(candidates), p=weights / weights.sum())])
+
+
+def continue_sequence(model, seed_ids, length, look_back, vocab_size, temperature=CONTINUATION_TEMPERATURE,
+                      top_k=CONTINUATION_TOP_K, rng=np.random):
+    """
+    Генерирует length новых нот после seed_ids, подавая сети ее же предсказания.
+    Все индексы лежат в заранее выделенном массиве, окно - срез этого массива,
+    а one-hot вход сети один и тот же и обновляется на месте,
+    поэтому шаг не зависит от длины уже сгенерированного
+    """
+    if len(seed_ids) < look_back:
+        raise ValueError(f'Need at least {look_back} notes to continue, got {len(seed_ids)}')
+
+    ids = np.empty(look_back + length, dtype=np.int32)
+    ids[:look_back] = seed_ids[len(seed_ids) - look_back:]
+    x = np.zeros((1, look_back, vocab_size), dtype=np.float32)
+    positions = np.arange(look_back)
+
+    for step in range(length):
+        window = ids[step:step + look_back]
+        if hasattr(model, 'predict_ids'):
+            probs = model.predict_ids(window[None])[0]
+        else:
+            x.fill(0)
+            x[0, positions, window] = 1
+            probs = model.predict_on_batch(x)[0]
+        ids[look_back + step] = sample_next(probs, temperature, top_k, rng)
+    return ids[look_back:]
+
+
+def run_continuation(midi, bundle, processed_file_path, digest=None, timings=None, on_stage=None,
+                     mode=GENERATION_MODE, length=CONTINUATION_LENGTH):
+    """
+    Продолжение мелодии на length нот (mode - extend или continue, см. extended_this).
+    Случайность зависит только от digest, поэтому результат для одного файла
+    всегда одинаковый и его можно кешировать
+    """
+    with stage(timings, 'tokenize', on_stage):
+        notes = get_cached_msg(midi, digest)
+    with stage(timings, 'snap', on_stage):
+        notes = bundle.snapper.snap(notes)
+    with stage(timings, 'encode', on_stage):
+        ids = bundle.snapper.encode(notes)
+    encoder = bundle.encoder
+    rng = np.random.RandomState(int(digest[:8], 16) if digest else None)
+
+    # Окна строятся по ходу генерации, отдельного этапа windows нет
+    print(f"Генерируем продолжение из {length} нот...")
+    with stage(timings, 'predict', on_stage):
+        predicted = continue_sequence(bundle.model, ids, length, bundle.look_back,
+                                      len(encoder.classes_), rng=rng)
+
+    with stage(timings, 'decode', on_stage):
+        new_notes = list(encoder.classes_[predicted])
+        if mode == 'extend':
+            new_notes = list(notes) + new_notes
+
+    with stage(timings, 'write', on_stage):
+        if WRITER_MODE == 'events':
+            write_midi(new_notes, processed_file_path)
+        else:
+            create_midi(new_notes, processed_file_path)
+    return new_notes
+
 
-    print("Загрузка ngram, для поиска похожих нот...")
-    G = joblib.load("./ml_models/encoders/ngram_classic_main2_5.sav")
-    for i in range(len(notes)):
-        print(notes[i], G.find(notes[i]))
-        notes[i] = G.find(notes[i])
+# Этапы run_pipeline по порядку
+PIPELINE_STAGES = ['tokenize', 'snap', 'encode', 'windows', 'predict', 'decode', 'write']
+
+
+@contextmanager
+def stage(timings, name, on_stage=None):
+    """
+    Замеряет время этапа обработки, если передан словарь timings,
+    и сообщает о начале этапа в on_stage(name)
+    """
+    if on_stage is not None:
+        on_stage(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+def run_pipeline(midi, bundle, processed_file_path, digest=None, timings=None, on_stage=None):
+    """
+    Все этапы обработки midi для уже загруженной сети:
+    токены -> словарь -> индексы -> окна -> сеть -> ноты -> midi
+    """
+    with stage(timings, 'tokenize', on_stage):
+        notes = get_cached_msg(midi, digest)
+
+    print("Ищем похожие ноты в словаре...")
+    with stage(timings, 'snap', on_stage):
+        notes = bundle.snapper.snap(notes)
+    print(f'Статистика словаря: {bundle.snapper.stats()}')
 
     print("Берем из словаря коды для каждой ноты...")
-    encoder = LabelBinarizer()
-    encoder.fit(notes)
-    encoder = joblib.load("./ml_models/encoders/LabelBinarizer_classic_main2_5.sav")
-    data = encoder.transform(notes)
+    with stage(timings, 'encode', on_stage):
+        ids = bundle.snapper.encode(notes)
+    encoder = bundle.encoder
 
     print("Создаем датасет...")
-    look_back = 2
-    trainX, trainY = create_dataset(data, look_back)
-
-    print('Загружаем сеть...')
-    model = load_model("./ml_models/models/Classic.h5")
+    with stage(timings, 'windows', on_stage):
+        windows, _ = window_dataset(ids, bundle.look_back)
 
     print("Генерируем...")
-    Y = extended_this(model=model, trainX=trainX, trainY=trainY, look_back=look_back)
+    with stage(timings, 'predict', on_stage):
+        predicted = predict_batched(bundle.model, windows, vocab_size=len(encoder.classes_))
 
     print("Расшифруем полученые данные в мелодию...")
-    new_notes = []
-    text_labels = encoder.classes_
-    for i in range(len(Y)):
-        # Ищем индекс самой вероятной ноты
-        pred = Y[i]
-        top = nlargest(1, enumerate(pred), operator.itemgetter(1))
-        top = top[0][0]
-        # Загружаем из словаря по индексу ноту
-        predicted_label = text_labels[top]
-        # print(predicted_label)
-        new_notes.append(predicted_label)
+    with stage(timings, 'decode', on_stage):
+        # Загружаем из словаря по индексу ноты
+        new_notes = list(encoder.classes_[predicted])
 
-    dir_name = os.path.dirname(midi)
-    file_name = os.path.basename(midi)
-    processed_file_path = dir_name + "/processed_" + file_name
-    create_midi(new_notes, processed_file_path)
-    print("Created: " + processed_file_path)
-    return processed_file_path
+    with stage(timings, 'write', on_stage):
+        if WRITER_MODE == 'events':
+            write_midi(new_notes, processed_file_path)
+        else:
+            create_midi(new_notes, processed_file_path)
+    return new_notes
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_predicted_notes(tokens, bundle, chunk_size=STREAM_CHUNK_SIZE, timings=None):
+    """
+    Генератор: токены midi кусками по chunk_size -> куски предсказанных нот.
+    Между кусками переносится хвост из look_back + 1 индексов, поэтому
+    окна получаются те же, что и в run_pipeline
+    """
+    encoder = bundle.encoder
+    tail = np.zeros(0, dtype=np.int32)
+    chunks = iter_chunks(tokens, chunk_size)
+    while True:
+        with stage(timings, 'tokenize'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+
+        with stage(timings, 'snap'):
+            labels = bundle.snapper.snap(chunk)
+        with stage(timings, 'encode'):
+            ids = np.concatenate([tail, bundle.snapper.encode(labels)])
+        with stage(timings, 'windows'):
+            windows, _ = window_dataset(ids, bundle.look_back)
+            tail = ids[len(windows):].copy()
+        if len(windows) == 0:
+            continue
+
+        with stage(timings, 'predict'):
+            predicted = predict_batched(bundle.model, windows, vocab_size=len(encoder.classes_))
+        with stage(timings, 'decode'):
+            yield list(encoder.classes_[predicted])
+
+
+def run_streaming_pipeline(midi, bundle, processed_file_path, digest=None, timings=None, on_stage=None,
+                           on_preview=None, chunk_size=STREAM_CHUNK_SIZE, preview_every=STREAM_PREVIEW_EVERY):
+    """
+    То же, что run_pipeline, но окна, предсказания и запись идут кусками,
+    и в памяти держится только текущий кусок. Разбор midi так не умеет:
+    и music21, и events строят элементы всех треков до первого токена,
+    поэтому память на этапе tokenize все равно растет с длиной мелодии.
+
+    on_preview(writer) вызывается, когда готово preview_every нот, потом
+    каждый раз, когда нот стало вдвое больше. writer.write(fp) сохраняет
+    все, что уже готово, поэтому при постоянном шаге объем превью рос бы
+    квадратично, а так он не больше двух итоговых файлов
+    """
+    if on_stage is not None:
+        on_stage('tokenize')
+
+    tokens = result_cache.iter_tokens(digest, TOKENIZER_MODE) if digest else None
+    if tokens is None:
+        tokens = iter_cached_msg(midi, digest) if digest else iter_msg(midi)
+
+    writer = MidiWriter()
+    try:
+        next_preview = preview_every
+        for notes in iter_predicted_notes(tokens, bundle, chunk_size, timings):
+            with stage(timings, 'write'):
+                writer.add(notes)
+            if on_preview is not None and preview_every and writer.count >= next_preview:
+                on_preview(writer)
+                next_preview = max(writer.count + preview_every, 2 * writer.count)
 
+        if on_stage is not None:
+            on_stage('write')
+        with stage(timings, 'write'):
+            writer.write(processed_file_path)
+        return writer.count
+    finally:
+        writer.close()
 
 
+def proc(midi_file, genre, digest=None, output=None, on_stage=None, on_preview=None):
+    """
+    on_stage(name) вызывается в начале каждого этапа из PIPELINE_STAGES,
+    on_preview(writer) - для промежуточного результата при STREAMING_GENERATION
+    midi_file - путь до файла, байты или файловый объект.
+    Для пути результат пишется рядом в processed_<имя> и возвращается путь,
+    иначе в output (по умолчанию BytesIO), который возвращается с позицией 0.
+    digest - хеш содержимого midi, если задан, токены берутся из кеша
+    """
+    bundle = registry.get(genre)
 
+    def pipeline(midi, processed_file_path):
+        if GENERATION_MODE != 'remake':
+            return run_continuation(midi, bundle, processed_file_path, digest=digest, on_stage=on_stage)
+        if STREAMING_GENERATION:
+            return run_streaming_pipeline(midi, bundle, processed_file_path, digest=digest,
+                                          on_stage=on_stage, on_preview=on_preview)
+        return run_pipeline(midi, bundle, processed_file_path, digest=digest, on_stage=on_stage)
+
+    if isinstance(midi_file, (bytes, bytearray)):
+        midi_file = io.BytesIO(midi_file)
+
+    if not isinstance(midi_file, str):
+        output = io.BytesIO() if output is None else output
+        pipeline(midi_file, output)
+        output.seek(0)
+        return output
+
+    print("Start processing script for file path: " + midi_file)
+    print("Current dir content: ")
+    print(os.listdir('.'), sep='\n')
+    print("Temp dir:")
+    print(*glob.glob('./temp'), sep='\n')
+
+    dir_name = os.path.dirname(midi_file)
+    file_name = os.path.basename(midi_file)
+    processed_file_path = dir_name + "/processed_" + file_name
+    pipeline(midi_file, processed_file_path)
+    print("Created: " + processed_file_path)
+    return processed_file_path
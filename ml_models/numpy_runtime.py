@@ -0,0 +1,203 @@
+"""
+Предсказание сетей Keras на чистом NumPy, без TensorFlow.
+Веса и описание слоев экспортируются в .npz (export_model),
+NumpyModel повторяет predict и predict_on_batch модели Keras
+"""
+import json
+
+import numpy as np
+
+SUPPORTED_LAYERS = ('Conv1D', 'Flatten', 'Dense', 'Dropout', 'Activation', 'InputLayer')
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'softmax': softmax,
+}
+
+
+def activation(name):
+    if name not in ACTIVATIONS:
+        raise ValueError(f'Unsupported activation: {name}')
+    return ACTIVATIONS[name]
+
+
+def export_model(model, path):
+    """
+    Сохраняет слои и веса модели Keras в .npz
+    """
+    layers, arrays = [], {}
+    for index, layer in enumerate(model.layers):
+        class_name = layer.__class__.__name__
+        if class_name not in SUPPORTED_LAYERS:
+            raise ValueError(f'Layer {layer.name} ({class_name}) is not supported by numpy runtime')
+        weights = layer.get_weights()
+        layers.append({'class_name': class_name, 'config': layer.get_config(), 'weights': len(weights)})
+        for number, weight in enumerate(weights):
+            arrays[f'layer{index}_{number}'] = weight.astype(np.float32)
+
+    np.savez(path, layers=np.array(json.dumps(layers)), **arrays)
+
+
+class Conv1D(object):
+    def __init__(self, config, kernel, bias=None):
+        self.kernel = kernel  # (kernel_size, in, out)
+        self.bias = bias
+        self.stride = config['strides'][0]
+        self.dilation = config['dilation_rate'][0]
+        self.padding = config['padding']
+        self.activation = activation(config['activation'])
+
+    def _pad(self, x):
+        size = len(self.kernel)
+        span = self.dilation * (size - 1)
+        if self.padding == 'causal':
+            left, right = span, 0
+        elif self.padding == 'same':
+            length = x.shape[1]
+            out_length = -(-length // self.stride)
+            total = max((out_length - 1) * self.stride + span + 1 - length, 0)
+            left, right = total // 2, total - total // 2
+        else:
+            return x
+        return np.pad(x, [(0, 0), (left, right)] + [(0, 0)] * (x.ndim - 2), 'constant')
+
+    def _taps(self, length):
+        """
+        Срезы входа по времени для каждого элемента ядра
+        """
+        out_length = (length - self.dilation * (len(self.kernel) - 1) - 1) // self.stride + 1
+        for j in range(len(self.kernel)):
+            start = j * self.dilation
+            yield j, slice(start, start + (out_length - 1) * self.stride + 1, self.stride)
+
+    def __call__(self, x):
+        x = self._pad(x)
+        out = 0
+        for j, taps in self._taps(x.shape[1]):
+            out = out + x[:, taps].dot(self.kernel[j])
+        return self.activation(out + self.bias if self.bias is not None else out)
+
+    def call_ids(self, ids):
+        """
+        То же для one-hot входа, заданного индексами: умножение
+        на one-hot - это просто выбор строк ядра
+        """
+        ids = self._pad(ids + 1) - 1  # -1 - нулевой вектор паддинга
+        out = 0
+        for j, taps in self._taps(ids.shape[1]):
+            rows = ids[:, taps]
+            out = out + np.where((rows >= 0)[..., None], self.kernel[j][rows], 0)
+        return self.activation(out + self.bias if self.bias is not None else out)
+
+
+class Dense(object):
+    def __init__(self, config, kernel, bias=None):
+        self.kernel = kernel  # (in, out)
+        self.bias = bias
+        self.activation = activation(config['activation'])
+
+    def __call__(self, x):
+        out = x.dot(self.kernel)
+        return self.activation(out + self.bias if self.bias is not None else out)
+
+    def call_ids(self, ids):
+        out = self.kernel[ids]
+        return self.activation(out + self.bias if self.bias is not None else out)
+
+
+class Flatten(object):
+    def __init__(self, config):
+        pass
+
+    def __call__(self, x):
+        return x.reshape(len(x), -1)
+
+
+class Activation(object):
+    def __init__(self, config):
+        self.activation = activation(config['activation'])
+
+    def __call__(self, x):
+        return self.activation(x)
+
+
+class Identity(object):
+    # Dropout и InputLayer при предсказании ничего не делают
+    def __init__(self, config):
+        pass
+
+    def __call__(self, x):
+        return x
+
+
+LAYERS = {
+    'Conv1D': Conv1D,
+    'Dense': Dense,
+    'Flatten': Flatten,
+    'Activation': Activation,
+    'Dropout': Identity,
+    'InputLayer': Identity,
+}
+
+
+class NumpyModel(object):
+    """
+    Модель из .npz, созданного export_model. Вход - one-hot как у Keras,
+    либо сразу индексы нот (predict_ids), если первый слой это позволяет
+    """
+
+    def __init__(self, layers, vocab_size=None):
+        self.layers = layers
+        self.vocab_size = vocab_size
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            specs = json.loads(str(data['layers']))
+            layers = []
+            for index, spec in enumerate(specs):
+                weights = [data[f'layer{index}_{number}'] for number in range(spec['weights'])]
+                layers.append(LAYERS[spec['class_name']](spec['config'], *weights))
+
+        vocab_size = next((layer.kernel.shape[-2] for layer in layers if hasattr(layer, 'kernel')), None)
+        return cls(layers, vocab_size)
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+    def predict(self, x, batch_size=32, verbose=0):
+        if len(x) <= batch_size:
+            return self.predict_on_batch(x)
+        return np.concatenate([self.predict_on_batch(x[start:start + batch_size])
+                               for start in range(0, len(x), batch_size)])
+
+    def predict_ids(self, ids):
+        """
+        Предсказание для окон из индексов нот (batch, look_back)
+        без построения one-hot
+        """
+        layers = iter(self.layers)
+        for layer in layers:
+            if hasattr(layer, 'call_ids'):
+                x = layer.call_ids(np.asarray(ids))
+                break
+            if not isinstance(layer, Identity):
+                raise ValueError(f'{layer.__class__.__name__} can not take note indexes')
+        else:
+            raise ValueError('Model has no layers with weights')
+
+        for layer in layers:
+            x = layer(x)
+        return x
@@ -0,0 +1,163 @@
+import gc
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from music21.ext import joblib
+
+from ml_models.genres import load_manifest
+from ml_models.numpy_runtime import NumpyModel
+from ml_models.vocab import VocabSnapper
+
+# Сколько жанров одновременно держим в памяти воркера
+MAX_LOADED_MODELS = int(os.environ.get('MAX_LOADED_MODELS', 2))
+# keras - сеть из .h5 через Keras/TensorFlow,
+# numpy - веса из .npz (python -m ml_models.export_models) без TensorFlow
+MODEL_RUNTIME = os.environ.get('MODEL_RUNTIME', 'keras')
+
+ModelBundle = namedtuple('ModelBundle', ['genre', 'model', 'encoder', 'ngram', 'snapper', 'look_back'])
+
+
+class KerasModel(object):
+    """
+    Сеть Keras в своем tf.Graph и tf.Session. В TF1 все модели иначе
+    попадают в один граф по умолчанию, и выгруженная сеть из него
+    не удаляется; здесь граф и сессия закрываются вместе с моделью
+    """
+
+    def __init__(self, path):
+        # TensorFlow импортируется, только если он действительно нужен
+        import tensorflow as tf
+        from keras.models import load_model
+
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph)
+        with self.graph.as_default(), self.session.as_default():
+            self.model = load_model(path)
+            # Строим функцию предсказания сразу, чтобы ее можно было
+            # переиспользовать между задачами
+            self.model._make_predict_function()
+
+    def predict(self, x, batch_size=32, verbose=0):
+        with self.graph.as_default(), self.session.as_default():
+            return self.model.predict(x, batch_size=batch_size, verbose=verbose)
+
+    def predict_on_batch(self, x):
+        with self.graph.as_default(), self.session.as_default():
+            return self.model.predict_on_batch(x)
+
+    def close(self):
+        from keras import backend
+
+        self.session.close()
+        # Keras держит словари по графу, без этого граф не освободится
+        for name in ('_GRAPH_LEARNING_PHASES', '_GRAPH_UID_DICTS', '_GRAPH_VARIABLES', '_GRAPH_TF_OPTIMIZERS'):
+            getattr(backend.tensorflow_backend, name, {}).pop(self.graph, None)
+        self.model = self.session = self.graph = None
+
+
+class ModelRegistry(object):
+    """
+    Держит загруженные сети, энкодеры и ngram в памяти процесса,
+    чтобы каждая задача celery не загружала их с диска заново.
+    Жанры загружаются лениво, давно не используемые выгружаются (LRU)
+    """
+
+    def __init__(self, manifest=None, max_models=MAX_LOADED_MODELS, runtime=MODEL_RUNTIME):
+        self._manifest = manifest
+        self.max_models = max_models
+        self.runtime = runtime
+        self._bundles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = load_manifest()
+        return self._manifest
+
+    def genres(self):
+        return sorted(self.manifest.keys())
+
+    def get(self, genre):
+        with self._lock:
+            bundle = self._bundles.get(genre)
+            if bundle is not None:
+                self.hits += 1
+                self._bundles.move_to_end(genre)
+                return bundle
+
+            # Неизвестный жанр не должен выгружать загруженные сети
+            if genre not in self.manifest:
+                raise KeyError(f'Unknown genre: {genre}')
+            self.misses += 1
+            self._evict(self.max_models - 1)
+            bundle = self._load(genre)
+            self._bundles[genre] = bundle
+            return bundle
+
+    def preload(self, genres=None):
+        genres = genres or self.genres()
+        for genre in genres[:self.max_models]:
+            self.get(genre)
+
+    def clear(self):
+        with self._lock:
+            self._evict(0)
+
+    def stats(self):
+        return {
+            'loaded': list(self._bundles.keys()),
+            'runtime': self.runtime,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'load_time': round(self.load_time, 3)
+        }
+
+    def _evict(self, keep):
+        evicted = False
+        while len(self._bundles) > max(keep, 0):
+            genre, bundle = self._bundles.popitem(last=False)
+            if hasattr(bundle.model, 'close'):
+                bundle.model.close()
+            self.evictions += 1
+            evicted = True
+            print(f'Выгружаем жанр {genre}')
+        if evicted:
+            gc.collect()
+
+    def _load(self, genre):
+        info = self.manifest[genre]
+
+        start = time.time()
+        print(f'Загружаем сеть и словари для жанра {genre}...')
+        ngram = joblib.load(info['ngram'])
+        encoder = joblib.load(info['encoder'])
+        if 'vocab_size' in info and len(encoder.classes_) != info['vocab_size']:
+            raise ValueError(f'Encoder for {genre} has {len(encoder.classes_)} classes, '
+                             f'expected {info["vocab_size"]}')
+        model = self._load_model(info)
+        elapsed = time.time() - start
+        self.load_time += elapsed
+        print(f'Жанр {genre} загружен за {elapsed:.2f} с')
+
+        return ModelBundle(genre=genre, model=model, encoder=encoder, ngram=ngram,
+                           snapper=VocabSnapper(ngram, encoder.classes_),
+                           look_back=info.get('look_back', 2))
+
+    def _load_model(self, info):
+        if self.runtime == 'numpy':
+            if os.path.isfile(info['numpy_model']):
+                return NumpyModel.load(info['numpy_model'])
+            print(f'Нет {info["numpy_model"]} для MODEL_RUNTIME=numpy, загружаем сеть через Keras '
+                  f'(веса экспортирует python -m ml_models.export_models)')
+        return KerasModel(info['model'])
+
+
+registry = ModelRegistry()
@@ -0,0 +1,460 @@
+import io
+import math
+import struct
+from bisect import bisect_left
+from fractions import Fraction
+from functools import lru_cache
+
+from music21 import converter, instrument, note, chord, midi as m21midi
+
+# Квантование расстояния между нотами:
+# (0, 0.5] -> 0.5, (0.5, 1] -> 1, (1, 1.5] -> 1.5, больше -> 2
+OFFSET_BOUNDS = [0.5, 1, 1.5]
+OFFSET_VALUES = [0.5, 1, 1.5, 2]
+
+PITCH_NAMES = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+
+# Дальше все повторяет чтение midi в music21 (midiTracksToStreams, partitionByInstrument),
+# чтобы токены mode='events' совпадали с mode='music21'
+# Квантование offset и длительностей: кратные 1/4 и 1/3 четверти
+QUANTIZE_DIVISORS = (4, 3)
+# Порядок элементов с одинаковым offset (classSortOrder в music21)
+SORT_INSTRUMENT = -25
+SORT_META = {0x51: 1, 0x59: 2, 0x58: 4}  # темп, тональность, размер
+SORT_NOTE = 20
+CONDUCTOR_ALL_PARTS = (0x58, 0x59)  # размер и тональность копируются во все партии, темп - в первую
+# Предел знаменателя offset, как defaults.limitOffsetDenominator
+DENOMINATOR_LIMIT = 65535
+
+
+def quantize_offset(delta):
+    if delta == 0:
+        return 0
+    if delta < 0:
+        return delta
+    return OFFSET_VALUES[bisect_left(OFFSET_BOUNDS, delta)]
+
+
+def note_token(pitch, offset, octave, inst=None):
+    token = str(pitch) + "|" + str(offset) + "|" + str(octave)
+    return token if inst is None else token + "|" + inst
+
+
+def chord_token(normal_order, offset, inst=None):
+    token = '.'.join(str(n) for n in normal_order) + "|" + str(offset)
+    return token if inst is None else token + "|" + inst
+
+
+def iter_tokens(file, mode='music21'):
+    """
+    Генератор нот midi файла в виде строк словаря:
+    нота - pitch|offset|octave[|instrument], аккорд - normalOrder|offset[|instrument]
+    mode='music21' - через music21 stream, mode='events' - напрямую по событиям midi
+    """
+    if mode == 'events':
+        return iter_event_tokens(file)
+    return iter_stream_tokens(file)
+
+
+def parse_stream(file):
+    """
+    music21 stream из пути, байтов или файлового объекта
+    """
+    if isinstance(file, str):
+        return converter.parse(file)
+    midi_file = m21midi.MidiFile()
+    midi_file.readstr(_read_bytes(file))
+    return m21midi.translate.midiFileToStream(midi_file)
+
+
+def iter_stream_tokens(file):
+    midi = parse_stream(file)
+    parts = instrument.partitionByInstrument(midi)
+    if not parts:
+        print("NOT PARTS")
+        groups = [(midi.flat.notes, None)]
+    else:
+        groups = ((elem.recurse(), str(elem[0])) for elem in parts)
+
+    prev_offset = 0
+    for elements, inst in groups:
+        for element in elements:
+            new_offset = quantize_offset(element.offset - prev_offset)
+            if isinstance(element, note.Note):
+                yield note_token(element.pitch, new_offset, element.octave, inst)
+            elif isinstance(element, chord.Chord):
+                yield chord_token(element.normalOrder, new_offset, inst)
+            prev_offset = element.offset
+
+
+# Чтение событий midi без music21
+
+def normal_order(pitch_classes):
+    """
+    Нормальный порядок pitch class, как chord.normalOrder
+    """
+    return _normal_order(tuple(sorted(set(pitch_classes))))
+
+
+@lru_cache(maxsize=None)
+def _normal_order(pitch_classes):
+    # music21 выбирает порядок по таблицам Форте, наборов всего 4096
+    return chord.Chord(list(pitch_classes)).normalOrder
+
+
+@lru_cache(maxsize=None)
+def program_instrument(program):
+    """
+    Название и строка инструмента music21 для номера программы midi
+    """
+    try:
+        inst = instrument.instrumentFromMidiProgram(program)
+    except instrument.InstrumentException:
+        inst = instrument.Instrument()
+    return inst.instrumentName, str(inst)
+
+
+def op_frac(value):
+    """
+    Offset и длительности как хранит music21 (opFrac): двоичные дроби -
+    float, остальные - Fraction. Суммы music21 не приводит, поэтому
+    4.0 + Fraction(31, 3) дает неточный float, и это влияет на голоса и паузы
+    """
+    if isinstance(value, float):
+        if value.as_integer_ratio()[1] > DENOMINATOR_LIMIT:
+            return Fraction(value).limit_denominator(DENOMINATOR_LIMIT)
+        return value
+    if isinstance(value, int):
+        return float(value)
+    if value.denominator & (value.denominator - 1) == 0:
+        return value.numerator / value.denominator
+    return value
+
+
+def quantize_time(value):
+    """
+    Ближайшее кратное 1/4 или 1/3, как Stream.quantize в music21
+    """
+    found = []
+    for divisor in QUANTIZE_DIVISORS:
+        unit = 1.0 / divisor
+        low = math.floor(value / unit)
+        if value <= unit * low + unit / 2:
+            found.append((round(value - unit * low, 7), Fraction(low, divisor)))
+        else:
+            found.append((round(unit * (low + 1) - value, 7), Fraction(low + 1, divisor)))
+    return op_frac(min(found)[1])
+
+
+def highest_time(elements):
+    # Stream.highestTime: максимум offset + длительность без приведения,
+    # music21 кеширует его как float
+    highest = 0.0
+    for element in elements:
+        if element[0] + element[3] > highest:
+            highest = element[0] + element[3]
+    return float(highest)
+
+
+def _read_var_len(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_bytes(file):
+    if isinstance(file, (bytes, bytearray)):
+        return bytes(file)
+    if isinstance(file, io.IOBase) or hasattr(file, 'read'):
+        return file.read()
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+def iter_midi_tracks(data):
+    """
+    Разбирает заголовок midi, возвращает ticks per quarter и генератор
+    треков, каждый трек - генератор (tick, status, data1, data2).
+    Для meta событий status 0xFF, data1 - тип, data2 - данные
+    """
+    if data[:4] != b'MThd':
+        raise ValueError('Not a MIDI file')
+    header_len = struct.unpack('>I', data[4:8])[0]
+    _, track_count, division = struct.unpack('>HHH', data[8:14])
+    if division & 0x8000:
+        raise ValueError('SMPTE time division is not supported')
+
+    def tracks():
+        pos = 8 + header_len
+        for _ in range(track_count):
+            chunk_type = data[pos:pos + 4]
+            length = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+            start, pos = pos + 8, pos + 8 + length
+            if chunk_type == b'MTrk':
+                yield _iter_track_events(data, start, pos)
+
+    return division, tracks()
+
+
+def _iter_track_events(data, pos, end):
+    tick = 0
+    status = 0
+    while pos < end:
+        delta, pos = _read_var_len(data, pos)
+        tick += delta
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+
+        if status == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_var_len(data, pos + 1)
+            yield tick, status, meta_type, data[pos:pos + length]
+            pos += length
+        elif status in (0xF0, 0xF7):
+            length, pos = _read_var_len(data, pos)
+            pos += length
+        elif status & 0xF0 in (0xC0, 0xD0):
+            yield tick, status, data[pos], 0
+            pos += 1
+        else:
+            yield tick, status, data[pos], data[pos + 1]
+            pos += 2
+
+
+
+
+def iter_event_tokens(file):
+    """
+    Токены напрямую из событий midi, без music21 stream. Ноты, аккорды,
+    паузы и партии по инструментам собираются так же, как при чтении
+    midi в music21, поэтому токены совпадают с iter_stream_tokens
+    """
+    ticks_per_quarter, tracks = iter_midi_tracks(_read_bytes(file))
+
+    parts, conductor = [], []
+    for events in tracks:
+        events = list(events)
+        elements = _track_elements(events, ticks_per_quarter)
+        if any(status & 0xF0 == 0x90 and data2 for _, status, _, data2 in events):
+            parts.append(elements)
+        else:
+            conductor.extend(element for element in elements if element[4] == 'meta')
+    if not parts:
+        return
+
+    # Размер и тональность из треков без нот попадают во все партии, темп - в первую
+    conductor.sort(key=_sort_key)
+    for elements in parts:
+        for offset, order, _, duration, kind, meta_type in conductor:
+            if meta_type in CONDUCTOR_ALL_PARTS:
+                elements.append([offset, order, len(elements), duration, kind, meta_type])
+    for offset, order, _, duration, kind, meta_type in conductor:
+        if meta_type not in CONDUCTOR_ALL_PARTS:
+            parts[0].append([offset, order, len(parts[0]), duration, kind, meta_type])
+    for elements in parts:
+        elements.sort(key=_sort_key)
+
+    if not any(element[4] == 'instrument' for elements in parts for element in elements):
+        flat = sorted((element[0], track, element[2], element) for track, elements in enumerate(parts)
+                      for element in elements if element[4] in ('note', 'chord'))
+        yield from _element_tokens([element for *_, element in flat], None)
+        return
+
+    # Партия на каждое название инструмента, в нее попадают элементы
+    # от program change до следующего program change трека
+    names = {}
+    for track, elements in enumerate(parts):
+        instruments = [element for element in elements if element[4] == 'instrument']
+        offsets = [element[0] for element in elements]
+        highest = op_frac(highest_time(elements))
+        for number, inst in enumerate(instruments):
+            start = inst[0]
+            following = instruments[number + 1][0] if number + 1 < len(instruments) else highest
+            # Как getElementsByOffset: пустой ли промежуток, music21 решает
+            # по неприведенному концу, а ищет по приведенному
+            end = start + op_frac(following - start)
+            name, label = program_instrument(inst[5])
+            part = names.setdefault(name, (label, {}))[1]
+            if end > start:
+                span = elements[bisect_left(offsets, start):bisect_left(offsets, op_frac(end))]
+            else:
+                span = [element for element in elements if element[0] == start and not element[3]]
+            for element in span:
+                if element[4] != 'instrument' and (track, element[2]) not in part:
+                    part[track, element[2]] = (element[0], element[1], len(part), element)
+
+    for label, part in names.values():
+        yield from _element_tokens([element for *_, element in sorted(part.values())], label)
+
+
+def _sort_key(element):
+    return element[0], element[1], element[2]
+
+
+def _track_elements(events, ticks_per_quarter):
+    """
+    Элементы трека как у midiTrackToStream в music21:
+    [offset, порядок, номер вставки, длительность, вид, значение],
+    offset и длительности квантованы, промежутки заполнены паузами
+    """
+    elements, notes, pending = [], [], {}
+    for index, (tick, status, data1, data2) in enumerate(events):
+        kind = status & 0xF0
+        if status == 0xFF:
+            if data1 in SORT_META:
+                elements.append([tick / ticks_per_quarter, SORT_META[data1], len(elements), 0, 'meta', data1])
+        elif kind == 0xC0:
+            elements.append([tick / ticks_per_quarter, SORT_INSTRUMENT, len(elements), 0, 'instrument', data1])
+        elif kind in (0x80, 0x90):
+            # Как в music21, нота заканчивается следующим событием той же ноты на том же канале
+            key = status & 0x0F, data1
+            if key in pending:
+                notes.append(pending.pop(key) + (tick, data1))
+            elif kind == 0x90 and data2:
+                pending[key] = index, tick
+    notes.sort()
+
+    # Ноты, начинающиеся и заканчивающиеся почти одновременно, объединяются в аккорд.
+    # Если начало совпадает, а конец нет, music21 раскладывает ноты по голосам
+    tolerance = ticks_per_quarter / 16
+    gathered, voices_required = set(), False
+    for i, (_, start, end, pitch) in enumerate(notes):
+        if i in gathered:
+            continue
+        group = None
+        for j in range(i + 1, len(notes)):
+            _, sub_start, sub_end, _ = notes[j]
+            if abs(sub_start - start) > tolerance:
+                break
+            if abs(sub_end - end) > tolerance:
+                voices_required = True
+                continue
+            if group is None:
+                group = [notes[i]]
+                gathered.add(i)
+            group.append(notes[j])
+            gathered.add(j)
+
+        if group is None:
+            duration = end - start
+            elements.append([start / ticks_per_quarter, SORT_NOTE, len(elements),
+                             duration / ticks_per_quarter if duration else 1, 'note', pitch])
+        else:
+            duration = group[0][2] - group[-1][1]
+            elements.append([start / ticks_per_quarter, SORT_NOTE, len(elements),
+                             duration / ticks_per_quarter if duration else 1, 'chord',
+                             [note_pitch for *_, note_pitch in group]])
+
+    for element in elements:
+        element[0] = quantize_time(element[0])
+        element[3] = quantize_time(max(element[3], 0))
+    elements.sort(key=_sort_key)
+
+    if voices_required:
+        return _make_voices(elements)
+    return elements + _find_gaps(elements, len(elements))
+
+
+def _find_gaps(elements, index, voice=False):
+    """
+    Паузы на месте промежутков между отсортированными элементами,
+    как findGaps в makeRests(fillGaps=True), index - номер вставки первой паузы.
+    Ноты, перенесенные в голос, music21 здесь видит с offset 0 (activeSite теряется)
+    """
+    rests, highest = [], 0.0
+    for offset, _, _, duration, kind, _ in elements:
+        if voice and kind != 'rest':
+            offset = 0.0
+        if offset > highest:
+            rests.append([highest, SORT_NOTE, index + len(rests), op_frac(offset - highest), 'rest', None])
+        highest = op_frac(max(highest, offset + duration))
+    return rests
+
+
+def _make_voices(elements):
+    """
+    Раскладывает перекрывающиеся ноты по голосам, как Stream.makeVoices
+    в music21, и возвращает элементы в порядке после flat.
+    Паузы, как и в music21, получают все голоса, кроме последнего
+    """
+    notes = [element for element in elements if element[4] in ('note', 'chord')]
+    others = [element for element in elements if element[4] not in ('note', 'chord')]
+
+    # Группы перекрывающихся нот (getOverlaps), голосов столько, сколько нот в самой большой группе
+    spans = [(offset, op_frac(offset + duration)) for offset, _, _, duration, _, _ in notes]
+    overlaps = [[] for _ in notes]
+    for i in range(len(notes)):
+        for j in range(i + 1, len(notes)):
+            first, second = sorted([spans[i], spans[j]])
+            if second[0] >= first[1]:
+                break
+            overlaps[i].append(j)
+            overlaps[j].append(i)
+    groups, members = {}, {}
+    for i, indexes in enumerate(overlaps):
+        if not indexes:
+            continue
+        key = None
+        for j in indexes:
+            if j in members:
+                key = members[j]
+                continue
+            if key is None:
+                key = notes[i][0]
+            groups.setdefault(key, []).append(j)
+            members[j] = key
+        if i not in members:
+            groups.setdefault(key, []).append(i)
+            members[i] = key
+    count = max((len(group) for group in groups.values()), default=1)
+    if count == 1:
+        return elements
+
+    # Нота идет в первый голос, который к ее началу закончился;
+    # если такого нет, music21 ее теряет
+    voices = [[] for _ in range(count)]
+    for element in notes:
+        for voice in voices:
+            if highest_time(voice) <= element[0]:
+                voice.append(element)
+                break
+    voices = [voice for voice in voices if voice]
+
+    # Перед первым голосом паузы ставятся между элементами самой партии,
+    # потом убираются, но успевают попасть в ее highestTime
+    top = others + _find_gaps(others, 0)
+    for number in range(1, len(voices)):
+        target = highest_time(top + [[0.0, 0, 0, op_frac(highest_time(voice)), None, None]
+                                     for voice in voices[:number]])
+        for voice in voices[:number]:
+            voice_start, voice_end = min(element[0] for element in voice), highest_time(voice)
+            if voice_start > 0:
+                voice.append([0.0, SORT_NOTE, 0, op_frac(voice_start), 'rest', None])
+            if target - voice_end > 0:
+                voice.append([op_frac(float(voice_end)), SORT_NOTE, 0, op_frac(target - voice_end), 'rest', None])
+            voice.sort(key=lambda element: (element[0], element[1]))
+            voice.extend(_find_gaps(voice, 0, voice=True))
+            voice.sort(key=lambda element: (element[0], element[1]))
+
+    ordered = others + [element for voice in voices for element in voice]
+    for index, element in enumerate(ordered):
+        element[2] = index
+    ordered.sort(key=_sort_key)
+    return ordered
+
+
+def _element_tokens(elements, inst):
+    prev_offset = 0
+    for offset, _, _, _, kind, value in elements:
+        new_offset = quantize_offset(offset - prev_offset)
+        if kind == 'note':
+            octave = value // 12 - 1
+            yield note_token(PITCH_NAMES[value % 12] + str(octave), new_offset, octave, inst)
+        elif kind == 'chord':
+            yield chord_token(normal_order(pitch % 12 for pitch in value), new_offset, inst)
+        prev_offset = offset
@@ -0,0 +1,90 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Сколько результатов нечеткого поиска храним на один жанр
+FUZZY_CACHE_SIZE = int(os.environ.get('FUZZY_CACHE_SIZE', 50000))
+
+
+class VocabSnapper(object):
+    """
+    Приводит ноты из midi к словарю сети:
+    сначала точное совпадение с классами энкодера, затем
+    нечеткий поиск по ngram с кешем результатов (LRU)
+    """
+
+    def __init__(self, ngram, classes, cache_size=FUZZY_CACHE_SIZE):
+        self.ngram = ngram
+        self.exact = {label: i for i, label in enumerate(classes)}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    def snap(self, notes):
+        """
+        Возвращает ноты из словаря, ноты без совпадений выбрасываются
+        """
+        mapping = {}
+        for token in set(notes):
+            mapping[token] = self._snap_token(token)
+
+        snapped = []
+        for token in notes:
+            label = mapping[token]
+            if token in self.exact:
+                self.exact_hits += 1
+            elif label in self.exact:
+                self.fuzzy_hits += 1
+            else:
+                self.misses += 1
+                continue
+            snapped.append(label)
+        return snapped
+
+    def snap_indexes(self, notes):
+        """
+        То же, что snap, но возвращает индексы нот в словаре энкодера (int32)
+        """
+        return self.encode(self.snap(notes))
+
+    def encode(self, labels):
+        """
+        Индексы нот из словаря (результат snap) в словаре энкодера
+        """
+        return np.array([self.exact[label] for label in labels], dtype=np.int32)
+
+    def _snap_token(self, token):
+        if token in self.exact:
+            return token
+
+        with self._lock:
+            if token in self._cache:
+                self.cache_hits += 1
+                self._cache.move_to_end(token)
+                return self._cache[token]
+
+        label = self.ngram.find(token)
+
+        with self._lock:
+            self._cache[token] = label
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return label
+
+    def stats(self):
+        total = self.exact_hits + self.fuzzy_hits + self.misses
+        return {
+            'exact': self.exact_hits,
+            'fuzzy': self.fuzzy_hits,
+            'miss': self.misses,
+            'cached_lookups': self.cache_hits,
+            'cache_size': len(self._cache),
+            'exact_rate': round(self.exact_hits / total, 3) if total else None,
+            'miss_rate': round(self.misses / total, 3) if total else None
+        }
@@ -0,0 +1,27 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def window_count(length, look_back=1, stride=1):
+    # Столько же окон, сколько дает create_dataset при stride=1
+    return max(0, (length - look_back - 1 + stride - 1) // stride)
+
+
+def window_dataset(dataset, look_back=1, stride=1):
+    """
+    То же, что create_dataset, но без копирования данных:
+    X = [n-look_back, ..., n-1] и Y = [n] возвращаются как read-only view
+    на dataset. Работает для массива индексов и для one-hot матрицы
+    """
+    dataset = np.asarray(dataset)
+    count = window_count(len(dataset), look_back, stride)
+    step = dataset.strides[0]
+
+    X = as_strided(dataset,
+                   shape=(count, look_back) + dataset.shape[1:],
+                   strides=(step * stride, step) + dataset.strides[1:],
+                   writeable=False)
+    Y = dataset[look_back:look_back + count * stride:stride]
+    Y.flags.writeable = False
+    return X, Y
+
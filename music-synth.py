@@ -1,4 +1,7 @@
-from app import app
+from app import app, db
 
 if __name__ == "__main__":
+    # При локальном запуске таблицы создаются сразу, в остальных случаях - flask db upgrade
+    with app.app_context():
+        db.create_all()
     app.run()
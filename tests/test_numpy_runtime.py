@@ -0,0 +1,105 @@
+"""
+NumpyModel должен предсказывать то же, что Keras: сравнение
+с прямым расчетом по весам, с маленькой сетью Keras (если он есть)
+и загрузка через Keras, когда .npz нет
+"""
+import json
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from ml_models.numpy_runtime import NumpyModel, export_model
+
+VOCAB_SIZE = 7
+LOOK_BACK = 4
+
+
+def _conv_config(padding, dilation=1):
+    return {'strides': [1], 'dilation_rate': [dilation], 'padding': padding, 'activation': 'relu'}
+
+
+def _save(path, specs, weights):
+    layers, arrays = [], {}
+    for index, ((class_name, config), layer_weights) in enumerate(zip(specs, weights)):
+        layers.append({'class_name': class_name, 'config': config, 'weights': len(layer_weights)})
+        for number, weight in enumerate(layer_weights):
+            arrays[f'layer{index}_{number}'] = weight.astype(np.float32)
+    np.savez(path, layers=np.array(json.dumps(layers)), **arrays)
+
+
+def _reference(x, kernel, bias, dense_kernel, dense_bias, dilation):
+    # Causal Conv1D, Flatten и Dense с softmax напрямую по определению
+    batch, length, _ = x.shape
+    size = len(kernel)
+    conv = np.zeros((batch, length, kernel.shape[-1]))
+    for t in range(length):
+        for j in range(size):
+            source = t - dilation * (size - 1 - j)
+            if source >= 0:
+                conv[:, t] += x[:, source].dot(kernel[j])
+    conv = np.maximum(conv + bias, 0)
+    logits = conv.reshape(batch, -1).dot(dense_kernel) + dense_bias
+    e = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _windows(count, seed=0):
+    ids = np.random.RandomState(seed).randint(0, VOCAB_SIZE, size=(count, LOOK_BACK))
+    x = np.zeros(ids.shape + (VOCAB_SIZE,), dtype=np.float32)
+    x.reshape(-1, VOCAB_SIZE)[np.arange(ids.size), ids.ravel()] = 1
+    return ids, x
+
+
+@pytest.mark.parametrize('dilation', [1, 2])
+def test_numpy_model_matches_reference(tmp_path, dilation):
+    rnd = np.random.RandomState(1)
+    kernel = rnd.randn(3, VOCAB_SIZE, 5)
+    bias = rnd.randn(5)
+    dense_kernel = rnd.randn(LOOK_BACK * 5, VOCAB_SIZE)
+    dense_bias = rnd.randn(VOCAB_SIZE)
+    path = str(tmp_path / 'model.npz')
+    _save(path, [('InputLayer', {}), ('Conv1D', _conv_config('causal', dilation)), ('Dropout', {}),
+                 ('Flatten', {}), ('Dense', {'activation': 'softmax'})],
+          [[], [kernel, bias], [], [], [dense_kernel, dense_bias]])
+
+    model = NumpyModel.load(path)
+    assert model.vocab_size == VOCAB_SIZE
+
+    ids, x = _windows(50)
+    expected = _reference(x, kernel, bias, dense_kernel, dense_bias, dilation)
+    np.testing.assert_allclose(model.predict(x, batch_size=16), expected, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(model.predict_ids(ids), expected, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('padding', ['valid', 'same', 'causal'])
+def test_numpy_model_matches_keras(tmp_path, padding):
+    keras = pytest.importorskip('keras')
+    from keras.layers import Conv1D, Dense, Dropout, Flatten
+
+    model = keras.models.Sequential([
+        Conv1D(6, 2, padding=padding, activation='relu', input_shape=(LOOK_BACK, VOCAB_SIZE)),
+        Dropout(0.2),
+        Flatten(),
+        Dense(VOCAB_SIZE, activation='softmax'),
+    ])
+    path = str(tmp_path / 'model.npz')
+    export_model(model, path)
+    numpy_model = NumpyModel.load(path)
+
+    ids, x = _windows(50)
+    expected = model.predict(x)
+    np.testing.assert_allclose(numpy_model.predict(x), expected, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(numpy_model.predict_ids(ids), expected, rtol=1e-4, atol=1e-6)
+
+
+def test_registry_falls_back_to_keras_without_npz(tmp_path, monkeypatch, capsys):
+    pytest.importorskip('music21')
+    from ml_models import registry as registry_module
+
+    monkeypatch.setattr(registry_module, 'KerasModel', lambda path: ('keras', path))
+    registry = registry_module.ModelRegistry(manifest={}, runtime='numpy')
+    info = {'model': 'Classic.h5', 'numpy_model': str(tmp_path / 'Classic.npz')}
+
+    assert registry._load_model(info) == ('keras', 'Classic.h5')
+    assert 'Classic.npz' in capsys.readouterr().out
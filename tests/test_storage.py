@@ -0,0 +1,66 @@
+"""
+S3Storage против бакета moto: загрузка, скачивание, чтение диапазона,
+head и новые клиенты после fork
+"""
+import io
+import os
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from app.storage import S3Storage
+from config import Config
+
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        config = {key: getattr(Config, key) for key in dir(Config) if key.startswith('S3_')}
+        boto3.client('s3').create_bucket(Bucket=config['S3_BUCKET_NAME'])
+        yield S3Storage(config)
+
+
+def test_upload_and_download(storage, tmp_path):
+    path = tmp_path / 'song.mid'
+    path.write_bytes(b'MThd' + bytes(range(256)))
+    storage.upload_file('1/song.mid', str(path))
+    storage.upload_fileobj('1/copy.mid', io.BytesIO(b'copy'))
+
+    downloaded = io.BytesIO()
+    storage.download_fileobj('1/song.mid', downloaded)
+    assert downloaded.getvalue() == path.read_bytes()
+    assert storage.get_object('1/copy.mid')['Body'].read() == b'copy'
+
+    stats = storage.stats()
+    assert stats['upload']['count'] == 2
+    assert stats['upload']['bytes'] == len(path.read_bytes()) + 4
+    assert stats['download']['bytes'] == len(path.read_bytes())
+
+
+def test_range_and_head(storage):
+    storage.upload_fileobj('1/song.mid', io.BytesIO(b'0123456789'))
+
+    assert storage.head_object('1/song.mid')['ContentLength'] == 10
+    part = storage.get_object('1/song.mid', Range='bytes=2-5')
+    assert part['Body'].read() == b'2345'
+
+    storage.delete('1/song.mid')
+    with pytest.raises(Exception):
+        storage.head_object('1/song.mid')
+    assert storage.stats()['head']['errors'] == 1
+
+
+def test_client_rebuilt_after_fork(storage, monkeypatch):
+    client = storage.client
+    assert storage.client is client
+
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    assert storage.client is not client
@@ -0,0 +1,33 @@
+"""
+Кеш проверенных токенов: срок жизни и сброс по токену и по юзеру
+"""
+import pytest
+
+pytest.importorskip('flask_sqlalchemy')
+
+from app.models import TokenCache, UserIdentity
+
+
+def identity(user_id):
+    return UserIdentity(id=user_id, username=f'user{user_id}', email=None)
+
+
+def test_entry_lives_no_longer_than_token():
+    cache = TokenCache(ttl=60, max_size=10)
+    cache.put('expired', identity(1), token_expires_at=0)
+    cache.put('valid', identity(1))
+
+    assert cache.get('expired') is None
+    assert cache.get('valid') == identity(1)
+
+
+def test_invalidate_token_and_user():
+    cache = TokenCache(ttl=60, max_size=10)
+    for token, user_id in [('a', 1), ('b', 1), ('c', 2)]:
+        cache.put(token, identity(user_id))
+
+    cache.invalidate('c')
+    assert cache.get('c') is None
+
+    cache.invalidate_user(1)
+    assert cache.get('a') is None and cache.get('b') is None
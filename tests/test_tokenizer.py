@@ -0,0 +1,57 @@
+"""
+Токены из событий midi (TOKENIZER_MODE=events) должны совпадать
+с токенами, которые дает чтение через music21
+"""
+import struct
+
+import pytest
+
+pytest.importorskip('music21')
+
+from benchmarks.fixtures import make_midi
+from ml_models.tokenizer import iter_event_tokens, iter_stream_tokens
+
+
+def _track(events):
+    body, last = b'', 0
+    for tick, data in events:
+        delta, out = tick - last, []
+        while True:
+            out.insert(0, delta & 0x7F | (0x80 if out else 0))
+            delta >>= 7
+            if not delta:
+                break
+        body += bytes(out) + data
+        last = tick
+    body += b'\x00\xff\x2f\x00'
+    return b'MTrk' + struct.pack('>I', len(body)) + body
+
+
+def _overlapping_midi(path):
+    # Трек без нот с темпом и размером, перекрывающиеся ноты (голоса),
+    # триоли и смена инструмента посреди трека
+    tpq = 96
+    conductor = [(0, b'\xff\x51\x03\x07\xa1\x20'), (0, b'\xff\x58\x04\x04\x02\x18\x08')]
+    notes = [(0, b'\xc0\x18'),
+             (tpq, b'\x90\x3c\x40'), (tpq, b'\x90\x40\x40'), (2 * tpq, b'\x80\x40\x00'),
+             (tpq * 4 // 3, b'\x90\x43\x40'), (3 * tpq, b'\x80\x3c\x00'), (3 * tpq, b'\x80\x43\x00'),
+             (5 * tpq, b'\xc0\x28'),
+             (5 * tpq, b'\x90\x45\x40'), (5 * tpq, b'\x90\x48\x40'), (6 * tpq, b'\x90\x45\x00'),
+             (6 * tpq, b'\x90\x48\x00')]
+    data = b'MThd' + struct.pack('>IHHH', 6, 1, 2, tpq)
+    data += _track(conductor) + _track(sorted(notes, key=lambda event: event[0]))
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize('notes, tracks', [(200, 1), (200, 3)])
+def test_event_tokens_match_music21(tmp_path, notes, tracks):
+    path = make_midi(str(tmp_path), notes, tracks=tracks)
+    assert list(iter_event_tokens(path)) == list(iter_stream_tokens(path))
+
+
+def test_event_tokens_match_music21_with_voices(tmp_path):
+    path = _overlapping_midi(tmp_path / 'voices.mid')
+    tokens = list(iter_event_tokens(path))
+    assert tokens
+    assert tokens == list(iter_stream_tokens(path))
@@ -0,0 +1,130 @@
+"""
+Загрузка мелодий на обработку против бакета moto: presigned POST
+(/api/songs/process/upload и /confirm) и загрузка через приложение
+(/api/songs/process) сразу в S3
+"""
+import base64
+import io
+import json
+import threading
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from app import app, db, storage
+from app import routes
+from app.models import User, Song, SynthInfo
+
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+GENRE = 'Classic'
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "app.db"}')
+    monkeypatch.setitem(app.config, 'TEMP_UPLOAD_URL', str(tmp_path / 'temp'))
+    monkeypatch.setattr(routes.processing_rate_limiter, 'hit', lambda user_id, amount=1: True)
+    monkeypatch.setattr(routes, 'get_available_genres', lambda: [GENRE])
+    # Клиенты S3 из других тестов созданы без moto
+    monkeypatch.setattr(storage, '_local', threading.local())
+
+    with mock_aws(), app.app_context():
+        boto3.client('s3').create_bucket(Bucket=storage.bucket)
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    calls = []
+    monkeypatch.setattr(routes, 'enqueue_processing', lambda *args, **kwargs: calls.append((args, kwargs)))
+    return calls
+
+
+@pytest.fixture
+def user():
+    user = User(username='user', email='user@example.com')
+    user.hash_password('password')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def auth(user):
+    return {'Authorization': user.generate_auth_token().decode('ascii')}
+
+
+def test_upload_returns_presigned_post_in_user_prefix(client, user):
+    response = client.post(f'/api/songs/process/upload?genre={GENRE}&filename=song.mid', headers=auth(user))
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert data['key'].startswith(f'temp/{user.id}/')
+    assert data['key'].endswith('/song.mid')
+    assert data['fields']['key'] == data['key']
+    policy = json.loads(base64.b64decode(data['fields']['policy']))
+    assert ['content-length-range', 1, app.config['S3_UPLOAD_MAX_SIZE']] in policy['conditions']
+
+
+def test_upload_rejects_unknown_genre_and_extension(client, user):
+    assert client.post('/api/songs/process/upload?genre=Jazz&filename=song.mid',
+                       headers=auth(user)).status_code == 500
+    assert client.post(f'/api/songs/process/upload?genre={GENRE}&filename=song.exe',
+                       headers=auth(user)).status_code == 500
+
+
+def test_confirm_rejects_key_of_another_user(client, user, enqueued):
+    key = f'temp/{user.id + 1}/abc/song.mid'
+    storage.upload_fileobj(key, io.BytesIO(b'MThd'))
+
+    response = client.post(f'/api/songs/process/confirm?genre={GENRE}&filename=song.mid&key={key}',
+                           headers=auth(user))
+    assert response.status_code == 500
+    assert Song.query.count() == 0
+    assert not enqueued
+
+
+def test_confirm_without_uploaded_object(client, user, enqueued):
+    key = f'temp/{user.id}/abc/song.mid'
+    response = client.post(f'/api/songs/process/confirm?genre={GENRE}&filename=song.mid&key={key}',
+                           headers=auth(user))
+    assert response.status_code == 500
+    assert Song.query.count() == 0
+    assert not enqueued
+
+
+def test_confirm_creates_song_and_enqueues(client, user, enqueued):
+    key = client.post(f'/api/songs/process/upload?genre={GENRE}&filename=song.mid',
+                      headers=auth(user)).get_json()['key']
+    # Файл загружает клиент по presigned POST
+    storage.upload_fileobj(key, io.BytesIO(b'MThd' + bytes(100)))
+
+    response = client.post(f'/api/songs/process/confirm?genre={GENRE}&filename=song.mid&key={key}',
+                           headers=auth(user))
+    assert response.status_code == 200
+
+    song = Song.query.one()
+    assert (song.name, song.user_id) == ('song.mid', user.id)
+    synth_info = SynthInfo.query.one()
+    assert (synth_info.genre, synth_info.processing_complete) == (GENRE, False)
+    assert enqueued == [(('song.mid', GENRE, synth_info.id, user.id, 104), {'s3_key': key})]
+
+
+def test_process_streams_upload_to_s3(client, user, enqueued, tmp_path):
+    data = {'song': (io.BytesIO(b'MThd' + bytes(60)), 'song.mid')}
+    response = client.post(f'/api/songs/process?genre={GENRE}', data=data, headers=auth(user),
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+
+    (args, kwargs), = enqueued
+    assert args[4] == 64
+    assert kwargs['s3_key'].startswith(f'temp/{user.id}/')
+    assert storage.get_object(kwargs['s3_key'])['Body'].read() == b'MThd' + bytes(60)
+    assert not (tmp_path / 'temp').exists()